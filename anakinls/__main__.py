@@ -9,6 +9,17 @@ logging.basicConfig(level=logging.INFO)
 logging.getLogger('pygls.protocol').setLevel(logging.WARN)
 
 
+def _positive_int(value: str) -> int:
+    try:
+        result = int(value)
+    except ValueError:
+        result = 0
+    if result < 1:
+        raise argparse.ArgumentTypeError(
+            f'must be a positive integer: {value}')
+    return result
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.description = 'Yet another Jedi Python language server'
@@ -33,6 +44,25 @@ def main():
         help='Print version and exit'
     )
 
+    subparsers = parser.add_subparsers(dest='command')
+    warm_cache_parser = subparsers.add_parser(
+        'warm-cache',
+        help='Parse modules of the environment and workspace into the '
+        'Jedi cache and exit'
+    )
+    warm_cache_parser.add_argument(
+        '--venv',
+        help='Path to virtualenv, same as `venv` initialization option'
+    )
+    warm_cache_parser.add_argument(
+        '--jobs', type=_positive_int,
+        help='Number of parallel processes. Default is number of CPUs'
+    )
+    warm_cache_parser.add_argument(
+        'paths', nargs='*', default=['.'],
+        help='Workspace folders. Default is current directory'
+    )
+
     args = parser.parse_args()
 
     if args.version:
@@ -44,6 +74,11 @@ def main():
         '''))
         return
 
+    if args.command == 'warm-cache':
+        from .cache import warm_cache
+        warm_cache(args.venv, args.paths, args.jobs)
+        return
+
     if args.tcp:
         server.start_tcp(args.host, args.port)
     else:
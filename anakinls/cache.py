@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import parso  # type: ignore
+from parso.cache import _get_hashed_path  # type: ignore
+
+from jedi import (create_environment,  # type: ignore
+                  get_default_environment,
+                  get_default_project,
+                  settings as jedi_settings)
+from jedi.inference import InferenceState  # type: ignore
+from jedi.inference.gradual.typeshed import TYPESHED_PATH  # type: ignore
+
+
+# Print progress every PROGRESS_STEP files
+PROGRESS_STEP = 500
+
+
+def _iter_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [
+                d for d in dirs
+                if not d.startswith('.') and d != '__pycache__'
+            ]
+            for filename in files:
+                if filename.endswith(('.py', '.pyi')):
+                    yield os.path.abspath(os.path.join(root, filename))
+
+
+def _get_stub_grammar_version(environment) -> str:
+    # Jedi parses stubs by its latest grammar instead of the one of the
+    # environment
+    version_info = InferenceState(
+        get_default_project(), environment).latest_grammar.version_info
+    return f'{version_info.major}.{version_info.minor}'
+
+
+def _parse(path: str, old_hash: Optional[str],
+           version: str) -> Tuple[str, Optional[str], str]:
+    """Parse file into the Jedi parser cache.
+
+    Return path, hash of the file content and what was done.
+    """
+    cache_path = Path(jedi_settings.cache_directory)
+    grammar = parso.load_grammar(version=version)
+    try:
+        with open(path, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        if content_hash == old_hash:
+            pickle_path = _get_hashed_path(grammar._hashed, path,
+                                           cache_path=cache_path)
+            if os.path.exists(pickle_path):
+                # Content is the same, but parso checks modification time
+                if os.path.getmtime(pickle_path) < os.path.getmtime(path):
+                    os.utime(pickle_path)
+                return path, content_hash, 'skipped'
+        grammar.parse(path=path, cache=True, diff_cache=False,
+                      cache_path=cache_path)
+    except Exception:
+        return path, None, 'failed'
+    return path, content_hash, 'parsed'
+
+
+def warm_cache(venv: Optional[str], paths: List[str],
+               jobs: Optional[int] = None):
+    """Parse modules of the environment and `paths` into the Jedi cache."""
+    if venv:
+        environment = create_environment(venv, False)
+    else:
+        environment = get_default_environment()
+    version_info = environment.version_info
+    version = f'{version_info.major}.{version_info.minor}'
+    stub_version = _get_stub_grammar_version(environment)
+    sys_path = [p for p in environment.get_sys_path() if os.path.isdir(p)]
+    # Stubs bundled with Jedi are not in sys.path of other environments
+    files = sorted(set(_iter_files(sys_path + paths + [str(TYPESHED_PATH)])))
+    print(f'Python {version} environment: {environment.executable}')
+    print(f'Files to check: {len(files)}')
+
+    manifest_path = os.path.join(
+        jedi_settings.cache_directory, f'anakinls-warm-cache-{version}.json')
+    try:
+        with open(manifest_path) as f:
+            manifest: Dict[str, str] = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    counters = {'parsed': 0, 'skipped': 0, 'failed': 0}
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(
+            _parse,
+            files,
+            (manifest.get(path) for path in files),
+            (stub_version if path.endswith('.pyi') else version
+             for path in files),
+            chunksize=64
+        )
+        for i, (path, content_hash, status) in enumerate(results, 1):
+            counters[status] += 1
+            if content_hash:
+                manifest[path] = content_hash
+            else:
+                manifest.pop(path, None)
+            if i % PROGRESS_STEP == 0 or i == len(files):
+                print(f'{i}/{len(files)}: ' + ', '.join(
+                    f'{k} {v}' for k, v in counters.items()))
+
+    os.makedirs(jedi_settings.cache_directory, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
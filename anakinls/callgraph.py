@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import time
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Bump when format of file indexes changes
+INDEX_VERSION = 1
+# Saved indexes not used for this long are deleted, same as parso does
+# with its cache
+INACTIVE_INDEX_AGE = 60 * 60 * 24 * 30
+
+# Name, receiver, line and column of a call site. Receiver is `None`
+# for plain names, dotted name like `self` or `os.path`, or `?` for any
+# other expression.
+Call = List[Any]
+# Index of a file: imports and scopes by qualified name. Calls at module
+# level belong to the scope with empty name.
+FileIndex = Dict[str, Any]
+# Path and qualified name of a function or class
+Target = Tuple[str, str]
+
+
+def get_hash(source: str) -> str:
+    return hashlib.sha256(source.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _scope(kind: str, node, name_leaf=None) -> Dict:
+    start = node.start_pos
+    end = node.end_pos
+    if name_leaf is None:
+        selection = [start[0] - 1, start[1], start[0] - 1, start[1]]
+    else:
+        line, column = name_leaf.start_pos
+        selection = [line - 1, column, line - 1,
+                     column + len(name_leaf.value)]
+    return {
+        'kind': kind,
+        'range': [start[0] - 1, start[1], end[0] - 1, end[1]],
+        'selection': selection,
+        'calls': []
+    }
+
+
+def _receiver(parts: list) -> str:
+    if parts[0].type != 'name':
+        return '?'
+    names = [parts[0].value]
+    for part in parts[1:]:
+        if part.type != 'trailer' or part.children[0] != '.':
+            return '?'
+        names.append(part.children[1].value)
+    return '.'.join(names)
+
+
+def _add_calls(node, calls: List[Call]):
+    children = node.children
+    first = 1 if children[0] == 'await' else 0
+    for i in range(first + 1, len(children)):
+        trailer = children[i]
+        if trailer.type != 'trailer' or trailer.children[0] != '(':
+            continue
+        callee = children[i - 1]
+        if i == first + 1:
+            if callee.type != 'name':
+                continue
+            name, receiver = callee, None
+        elif callee.type == 'trailer' and callee.children[0] == '.':
+            name = callee.children[1]
+            receiver = _receiver(children[first:i - 1])
+        else:
+            # e.g. f()() or a[0]()
+            continue
+        line, column = name.start_pos
+        calls.append([name.value, receiver, line - 1, column])
+
+
+def _add_imports(node, imports: Dict[str, str]):
+    if node.type == 'import_name':
+        for name, path in zip(node.get_defined_names(), node.get_paths()):
+            if name is path[0]:
+                # import a.b binds a
+                imports[name.value] = name.value
+            else:
+                imports[name.value] = '.'.join(n.value for n in path)
+    elif not node.is_star_import():
+        for name, path in zip(node.get_defined_names(), node.get_paths()):
+            imports[name.value] = '.' * node.level + '.'.join(
+                n.value for n in path)
+
+
+def _visit(node, qualname: str, scopes: Dict[str, Dict],
+           imports: Dict[str, str]):
+    calls = scopes[qualname]['calls']
+    for child in node.children:
+        child_type = child.type
+        if child_type in ('funcdef', 'classdef'):
+            name = child.name.value
+            if qualname:
+                name = f'{qualname}.{name}'
+            if child_type == 'classdef':
+                kind = 'class'
+            elif scopes[qualname]['kind'] == 'class':
+                kind = 'method'
+            else:
+                kind = 'function'
+            if name not in scopes:
+                # Redefinitions, e.g. property setters, share the scope
+                scopes[name] = _scope(kind, child, child.name)
+            _visit(child, name, scopes, imports)
+            continue
+        if child_type in ('import_name', 'import_from'):
+            _add_imports(child, imports)
+            continue
+        if child_type in ('atom_expr', 'power'):
+            _add_calls(child, calls)
+        if hasattr(child, 'children'):
+            _visit(child, qualname, scopes, imports)
+
+
+def build_index(module_node) -> FileIndex:
+    """Return imports and call sites of every function of the module.
+
+    Only the syntax tree is used: call sites are resolved to functions
+    later, when they are asked for.
+    """
+    scopes = {'': _scope('module', module_node)}
+    imports: Dict[str, str] = {}
+    _visit(module_node, '', scopes, imports)
+    return {'imports': imports, 'scopes': scopes}
+
+
+def find_scope(file_index: FileIndex, line: int,
+               column: int) -> Optional[str]:
+    """Return qualified name of the scope defined by name at position."""
+    for qualname, scope in file_index['scopes'].items():
+        if qualname and scope['selection'][:2] == [line, column]:
+            return qualname
+    return None
+
+
+class CallGraph:
+    """Indexes of files by path and names of their calls and definitions.
+
+    Indexes are saved in `cache_dir` by hash of the file content, so
+    unchanged files are not parsed again after restart. Saved index is
+    deleted when no file has its content anymore. Indexes of files
+    changed while the server was not running are deleted by
+    `clear_inactive` after a while.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.files: Dict[str, FileIndex] = {}
+        self._callers: Dict[str, Set[str]] = {}
+        self._definitions: Dict[str, Set[Target]] = {}
+        # Number of files by hash of their content
+        self._hashes: Dict[str, int] = {}
+
+    def _get_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, f'{content_hash}.json')
+
+    def load(self, content_hash: str) -> Optional[FileIndex]:
+        path = self._get_path(content_hash)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            # Used index is not inactive
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def clear_inactive(self, max_age: float = INACTIVE_INDEX_AGE):
+        """Delete saved indexes not loaded or saved for `max_age` seconds."""
+        threshold = time.time() - max_age
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return
+        for entry in entries:
+            # Temporary files of interrupted saves too
+            name, _, _ = entry.name.partition('.')
+            if name in self._hashes:
+                continue
+            try:
+                if entry.stat().st_mtime < threshold:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def save(self, content_hash: str, file_index: FileIndex):
+        path = self._get_path(content_hash)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Concurrent servers may save the same file
+            tmp_path = f'{path}.{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(file_index, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def _delete(self, content_hash: str):
+        try:
+            os.remove(self._get_path(content_hash))
+        except OSError:
+            pass
+
+    def add(self, path: str, content_hash: str, file_index: FileIndex):
+        old_index = self._forget(path)
+        file_index['hash'] = content_hash
+        self.files[path] = file_index
+        self._hashes[content_hash] = self._hashes.get(content_hash, 0) + 1
+        if old_index is not None and old_index['hash'] not in self._hashes:
+            self._delete(old_index['hash'])
+        for qualname, scope in file_index['scopes'].items():
+            if qualname:
+                name = qualname.rpartition('.')[2]
+                self._definitions.setdefault(name, set()).add(
+                    (path, qualname))
+            for call in scope['calls']:
+                self._callers.setdefault(call[0], set()).add(path)
+
+    def remove(self, path: str):
+        file_index = self._forget(path)
+        if file_index is not None and file_index['hash'] not in self._hashes:
+            self._delete(file_index['hash'])
+
+    def _forget(self, path: str) -> Optional[FileIndex]:
+        file_index = self.files.pop(path, None)
+        if file_index is None:
+            return None
+        content_hash = file_index['hash']
+        self._hashes[content_hash] -= 1
+        if not self._hashes[content_hash]:
+            del self._hashes[content_hash]
+        for qualname, scope in file_index['scopes'].items():
+            if qualname:
+                name = qualname.rpartition('.')[2]
+                self._definitions[name].discard((path, qualname))
+            for call in scope['calls']:
+                self._callers[call[0]].discard(path)
+        return file_index
+
+    def callers(self, name: str) -> Set[str]:
+        """Return paths of files calling something named `name`."""
+        return self._callers.get(name, set())
+
+    def definitions(self, name: str) -> Set[Target]:
+        """Return functions and classes named `name`."""
+        return self._definitions.get(name, set())
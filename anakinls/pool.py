@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, List, Optional
+
+
+def create_pool(size: int, initializer: Callable,
+                initargs: tuple = ()) -> Optional['WorkerPool']:
+    """Return pool of `size` workers or `None` if it is not supported."""
+    if sys.version_info < (3, 7):
+        logging.warning('Worker pool requires Python 3.7')
+        return None
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        logging.warning('Worker pool requires fork start method')
+        return None
+    # Forked child closes sys.stdin. It would hang forever as stdin
+    # buffer is locked by the thread reading requests. Server reads the
+    # buffer directly and sys.__stdin__ keeps it open.
+    if sys.stdin is not None:
+        sys.stdin = open(os.devnull)
+    return WorkerPool(size, context, initializer, initargs)
+
+
+class WorkerPool:
+    """Pool of forked single process executors.
+
+    Workers are forked on first use, so they get modules and caches
+    loaded by the server at that moment. Calls with the same key are
+    executed by the same worker. Crashed worker is replaced by a new one.
+    """
+
+    def __init__(self, size: int, context, initializer: Callable,
+                 initargs: tuple):
+        self.size = size
+        self._context = context
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executors: List[ProcessPoolExecutor] = [
+            self._create_executor() for _ in range(size)
+        ]
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=self._context,
+            initializer=self._initializer,
+            initargs=self._initargs
+        )
+
+    async def run(self, key: str, fn: Callable, *args: Any) -> Any:
+        """Execute `fn(*args)` by the worker responsible for `key`.
+
+        Raise `BrokenProcessPool` if the worker crashed.
+        """
+        idx = zlib.crc32(key.encode()) % self.size
+        try:
+            return await asyncio.wrap_future(
+                self._executors[idx].submit(fn, *args))
+        except BrokenProcessPool:
+            logging.error(f'Worker {idx} crashed on {key}, restarting')
+            self._executors[idx].shutdown(wait=False)
+            self._executors[idx] = self._create_executor()
+            raise
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False)
@@ -0,0 +1,148 @@
+import asyncio
+import enum
+import logging
+import time
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional
+
+
+class Priority(enum.IntEnum):
+    # Requests sent while typing: completion, signature help, hover
+    INTERACTIVE = 0
+    # Requests explicitly made by user: definition, references, etc.
+    USER = 1
+    # Diagnostics, modules warm up, workspace scan
+    BACKGROUND = 2
+
+
+class _Job:
+
+    def __init__(self, priority: Priority, fn: Callable, args: tuple,
+                 key: Optional[Hashable], future: asyncio.Future):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.future = future
+        self.queued = time.monotonic()
+
+    @property
+    def name(self) -> str:
+        return getattr(self.fn, '__name__', repr(self.fn))
+
+
+class Scheduler:
+    """Run jobs on the event loop in order of their priority.
+
+    Jedi is not thread safe, so jobs are executed on the loop one at a
+    time and the loop is released after every job to receive new
+    requests. Job of a lower priority is not started while there are
+    queued jobs of a higher priority. Running job is never interrupted,
+    so long background jobs should be split into smaller ones.
+
+    Coroutine functions keep their worker while awaiting, so number of
+    running coroutines of every priority is limited by `workers`.
+
+    Queue depth and wait time of every job are logged. Wait time longer
+    than priority's budget is logged as warning.
+    """
+
+    def __init__(self, workers: Dict[Priority, int],
+                 budgets: Dict[Priority, float]):
+        self.workers = workers
+        self.budgets = budgets
+        self._queues: Dict[Priority, Deque[_Job]] = {
+            priority: deque() for priority in Priority
+        }
+        self._running = {priority: 0 for priority in Priority}
+        self._keys: Dict[Hashable, _Job] = {}
+        self._dispatching = False
+
+    def submit(self, priority: Priority, fn: Callable, *args: Any,
+               key: Optional[Hashable] = None) -> asyncio.Future:
+        """Queue `fn(*args)` and return future of its result.
+
+        If not yet started job with the same `key` is queued, its future
+        is returned instead of queuing a new job.
+        """
+        if key is not None and key in self._keys:
+            return self._keys[key].future
+        loop = asyncio.get_event_loop()
+        job = _Job(priority, fn, args, key, loop.create_future())
+        self._queues[priority].append(job)
+        if key is not None:
+            self._keys[key] = job
+        self._schedule(loop)
+        return job.future
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop):
+        if not self._dispatching:
+            self._dispatching = True
+            loop.call_soon(self._dispatch)
+
+    def _next_job(self) -> Optional[_Job]:
+        for priority in Priority:
+            queue = self._queues[priority]
+            while queue and queue[0].future.cancelled():
+                job = queue.popleft()
+                self._keys.pop(job.key, None)
+            if not queue:
+                continue
+            if self._running[priority] >= self.workers[priority]:
+                # Don't let lower priorities in while this one waits
+                return None
+            return queue.popleft()
+        return None
+
+    def _dispatch(self):
+        self._dispatching = False
+        job = self._next_job()
+        if job is None:
+            return
+        self._keys.pop(job.key, None)
+        self._log_wait(job)
+        self._running[job.priority] += 1
+        loop = asyncio.get_event_loop()
+        if asyncio.iscoroutinefunction(job.fn):
+            task = asyncio.ensure_future(job.fn(*job.args))
+            task.add_done_callback(lambda t: self._coroutine_done(job, t))
+            job.future.add_done_callback(
+                lambda f: task.cancel() if f.cancelled() else None)
+        else:
+            try:
+                result = job.fn(*job.args)
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                self._running[job.priority] -= 1
+        if any(self._queues.values()):
+            self._schedule(loop)
+
+    def _coroutine_done(self, job: _Job, task: asyncio.Future):
+        self._running[job.priority] -= 1
+        if not job.future.done():
+            if task.cancelled():
+                job.future.cancel()
+            else:
+                exception = task.exception()
+                if exception is None:
+                    job.future.set_result(task.result())
+                else:
+                    job.future.set_exception(exception)
+        self._schedule(asyncio.get_event_loop())
+
+    def _log_wait(self, job: _Job):
+        wait = time.monotonic() - job.queued
+        depth = ', '.join(
+            f'{priority.name.lower()}={len(queue)}'
+            for priority, queue in self._queues.items()
+        )
+        message = (f'{job.name} ({job.priority.name.lower()}) waited '
+                   f'{wait * 1000:.1f}ms, queue depth: {depth}')
+        if wait > self.budgets[job.priority]:
+            logging.warning(message)
+        else:
+            logging.debug(message)
@@ -0,0 +1,226 @@
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+from parso.python.tree import ImportFrom  # type: ignore
+from parso.tree import search_ancestor  # type: ignore
+
+TOKEN_TYPES = [
+    'namespace',
+    'class',
+    'function',
+    'method',
+    'parameter',
+    'variable',
+    'property',
+    'decorator',
+    'keyword',
+    'string',
+    'number',
+    'comment'
+]
+TOKEN_MODIFIERS = [
+    'declaration'
+]
+
+(NAMESPACE, CLASS, FUNCTION, METHOD, PARAMETER, VARIABLE, PROPERTY,
+ DECORATOR, KEYWORD, STRING, NUMBER, COMMENT) = range(len(TOKEN_TYPES))
+DECLARATION = 1
+
+# Column, length, type and modifiers of a token
+Token = Tuple[int, int, int, int]
+# Start line and type of a top level node
+Node = Tuple[int, str]
+
+_STRING_LEAVES = ('string', 'fstring_start', 'fstring_string', 'fstring_end')
+
+
+def _is_call(leaf) -> bool:
+    trailer = leaf.get_next_sibling()
+    return (trailer is not None and trailer.type == 'trailer' and
+            trailer.children[0] == '(')
+
+
+def _name_token(leaf) -> Tuple[int, int]:
+    parent = leaf.parent
+    if parent.type == 'classdef' and parent.name is leaf:
+        return CLASS, DECLARATION
+    if parent.type == 'funcdef' and parent.name is leaf:
+        scope = search_ancestor(parent, 'classdef', 'funcdef')
+        if scope is not None and scope.type == 'classdef':
+            return METHOD, DECLARATION
+        return FUNCTION, DECLARATION
+    if parent.type == 'param' and parent.name is leaf:
+        return PARAMETER, DECLARATION
+    if parent.type == 'tfpdef' and parent.children[0] is leaf:
+        # Annotated parameter
+        return PARAMETER, DECLARATION
+    if (parent.type == 'argument' and parent.children[0] is leaf and
+            parent.children[1] == '='):
+        return PARAMETER, 0
+    if parent.type == 'trailer' and parent.children[0] == '.':
+        return (METHOD if _is_call(parent) else PROPERTY), 0
+    imp = search_ancestor(leaf, 'import_name', 'import_from')
+    if imp is not None:
+        if isinstance(imp, ImportFrom) and leaf in imp.get_defined_names():
+            return (CLASS if leaf.value[0].isupper() else VARIABLE), 0
+        return NAMESPACE, 0
+    if search_ancestor(leaf, 'decorator') is not None:
+        return DECORATOR, 0
+    if _is_call(leaf):
+        return (CLASS if leaf.value[0].isupper() else FUNCTION), 0
+    if leaf.is_definition():
+        return VARIABLE, DECLARATION
+    return VARIABLE, 0
+
+
+def _iter_leaves(node) -> Iterator:
+    for child in node.children:
+        if hasattr(child, 'children'):
+            yield from _iter_leaves(child)
+        else:
+            yield child
+
+
+def _add_comments(lines: List[List[Token]], start: int, leaf):
+    # Comments are in the prefix of the following leaf
+    line, column = leaf.get_start_pos_of_prefix()
+    line -= 1 + start
+    for part in leaf.prefix.split('\n'):
+        idx = part.find('#')
+        if idx >= 0 and 0 <= line < len(lines):
+            lines[line].append(
+                (column + idx, len(part.rstrip('\r')) - idx, COMMENT, 0))
+        line += 1
+        column = 0
+
+
+def get_tokens(nodes: list, start: int, end: int) -> List[List[Token]]:
+    """Return tokens of lines `start`..`end` (exclusive) found in `nodes`.
+
+    Tokens are grouped by line, so lines can be shifted without touching
+    the tokens.
+    """
+    lines: List[List[Token]] = [[] for _ in range(end - start)]
+    for node in nodes:
+        leaves = _iter_leaves(node) if hasattr(node, 'children') else (node,)
+        for leaf in leaves:
+            if '#' in leaf.prefix:
+                _add_comments(lines, start, leaf)
+            leaf_type = leaf.type
+            if leaf_type == 'name':
+                token_type, modifiers = _name_token(leaf)
+            elif leaf_type == 'keyword':
+                token_type, modifiers = KEYWORD, 0
+            elif leaf_type == 'number':
+                token_type, modifiers = NUMBER, 0
+            elif leaf_type in _STRING_LEAVES:
+                token_type, modifiers = STRING, 0
+            else:
+                continue
+            line, column = leaf.start_pos
+            line -= 1 + start
+            # Multiline strings are split as tokens can't span lines
+            for part in leaf.value.split('\n'):
+                if 0 <= line < len(lines) and part:
+                    lines[line].append(
+                        (column, len(part), token_type, modifiers))
+                line += 1
+                column = 0
+    return lines
+
+
+def _get_end_pos(node) -> Tuple[int, int]:
+    # Same as start of the next node's prefix. Unlike
+    # get_start_pos_of_prefix() it doesn't search node in its parent.
+    leaf = node.get_last_leaf()
+    while (leaf.type == 'error_leaf' and
+           leaf.token_type in ('INDENT', 'DEDENT', 'ERROR_DEDENT')):
+        leaf = leaf.get_previous_leaf()
+        if leaf is None:
+            # e.g. the first line is indented
+            return node.start_pos
+    return leaf.end_pos
+
+
+def get_region(
+        module_node, first: int, last: int, old_nodes: List[Node]
+) -> Tuple[int, Optional[int], list, List[Node]]:
+    """Return lines to update after lines `first`..`last` were changed.
+
+    Region is extended to whole top level nodes including comments
+    before them. Nodes not found in `old_nodes` are included too:
+    unclosed brackets or strings change how the following code is
+    parsed. Return start and end (`None` for the end of the document) of
+    the region, its nodes and start lines and types of all top level
+    nodes.
+    """
+    children = module_node.children
+    starts = [(1, 0)] + [_get_end_pos(child) for child in children[:-1]]
+    lines = [line - 1 for line, _ in starts]
+    nodes = [(line, child.type) for line, child in zip(lines, children)]
+    old = set(zip(old_nodes, old_nodes[1:] + [None]))
+    i = max(bisect_right(lines, first) - 1, 0)
+    j = max(bisect_right(lines, last) - 1, i)
+    for k, node in enumerate(zip(nodes, nodes[1:] + [None])):
+        if node not in old:
+            i = min(i, k)
+            j = max(j, k)
+    # Node might start in the middle of a line after a syntax error
+    while i > 0 and starts[i][1] != 0:
+        i -= 1
+    while j + 1 < len(children) and starts[j + 1][1] != 0:
+        j += 1
+    start = lines[i] if i else 0
+    end = lines[j + 1] if j + 1 < len(children) else None
+    return start, end, children[i:j + 1], nodes
+
+
+def encode(lines: List[List[Token]], line_offset: int = 0,
+           previous: Tuple[int, int] = (0, 0)) -> List[int]:
+    """Return tokens in the relative format of the protocol.
+
+    `previous` is position of the token before the first line.
+    """
+    result: List[int] = []
+    previous_line, previous_column = previous
+    for line, tokens in enumerate(lines, line_offset):
+        for column, length, token_type, modifiers in tokens:
+            if line == previous_line:
+                result += (0, column - previous_column, length,
+                           token_type, modifiers)
+            else:
+                result += (line - previous_line, column, length,
+                           token_type, modifiers)
+                previous_line = line
+            previous_column = column
+    return result
+
+
+def _last_position(lines: List[List[Token]], start: int, end: int,
+                   default: Tuple[int, int]) -> Tuple[int, int]:
+    for line in range(end - 1, start - 1, -1):
+        if lines[line]:
+            return line, lines[line][-1][0]
+    return default
+
+
+def get_edit(data: List[int], lines: List[List[Token]], start: int,
+             end: int) -> Tuple[int, int, List[int]]:
+    """Return edit of `data` after tokens of `start`..`end` lines changed.
+
+    Tokens of other lines must be the same as when `data` was encoded,
+    though they may be shifted. Edit is start, number of integers to
+    delete and integers to insert.
+    """
+    before = sum(map(len, lines[:start]))
+    after = sum(map(len, lines[end:]))
+    previous = _last_position(lines, 0, start, (0, 0))
+    insert = encode(lines[start:end], start, previous)
+    delete_end = len(data) - 5 * after
+    if after:
+        # Token after the region is relative to the last one in it
+        line = next(line for line in range(end, len(lines)) if lines[line])
+        insert += encode([lines[line][:1]], line,
+                         _last_position(lines, start, end, previous))
+        delete_end += 5
+    return 5 * before, delete_end - 5 * before, insert
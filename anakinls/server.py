@@ -1,9 +1,23 @@
+import asyncio
+import builtins
+import functools
+import heapq
+import itertools
+import json
 import logging
+import os
 import re
+import sys
+import time
 
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
 from difflib import Differ
 from inspect import Parameter
-from typing import List, Dict, Optional, Any, Iterator, Callable, Union
+from pathlib import Path
+from typing import (List, Dict, Optional, Any, Iterator, Callable, Union,
+                    Tuple, Set, Deque, Iterable, Type)
 
 from jedi import (Script, create_environment,  # type: ignore
                   get_default_environment,
@@ -12,10 +26,13 @@ from jedi import (Script, create_environment,  # type: ignore
 from jedi.api.classes import Name, Completion  # type: ignore
 from jedi.api.refactoring import Refactoring, ChangedFile  # type: ignore
 from parso import split_lines  # type: ignore
+from parso.cache import parser_cache  # type: ignore
 
 from pycodestyle import (BaseReport as CodestyleBaseReport,  # type: ignore
                          Checker as CodestyleChecker,
-                         StyleGuide as CodestyleStyleGuide)
+                         PROJECT_CONFIG as CODESTYLE_PROJECT_CONFIG,
+                         StyleGuide as CodestyleStyleGuide,
+                         module_imports_on_top_of_file)
 
 from pyflakes.api import check as pyflakes_check  # type: ignore
 
@@ -24,15 +41,46 @@ from pygls.features import (COMPLETION, TEXT_DOCUMENT_DID_CHANGE,
                             HOVER, SIGNATURE_HELP, DEFINITION,
                             REFERENCES, WORKSPACE_DID_CHANGE_CONFIGURATION,
                             TEXT_DOCUMENT_WILL_SAVE, TEXT_DOCUMENT_DID_SAVE,
-                            DOCUMENT_SYMBOL, CODE_ACTION)
+                            DOCUMENT_SYMBOL, CODE_ACTION, INITIALIZED,
+                            WORKSPACE_DID_CHANGE_WATCHED_FILES,
+                            TEXT_DOCUMENT_PUBLISH_DIAGNOSTICS)
 from pygls import types
 from pygls.server import LanguageServer
-from pygls.protocol import LanguageServerProtocol
+from pygls.protocol import (LanguageServerProtocol, default_serializer,
+                            deserialize_message)
 from pygls.uris import from_fs_path, to_fs_path
-
+from pygls.workspace import Workspace
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
+from .callgraph import CallGraph, FileIndex, Target
+from .pool import WorkerPool, create_pool
+from .scheduler import Priority, Scheduler
+from . import callgraph, semantic_tokens
+from .semantic_tokens import TOKEN_MODIFIERS, TOKEN_TYPES
 from .version import get_version
 
+protocol_logger = logging.getLogger('pygls.protocol')
+
 RE_WORD = re.compile(r'\w*')
+RE_WORD_END = re.compile(r'\w*$')
+
+# Same as mypy.defaults.CONFIG_FILES, mypy is optional. Files of the
+# workspace folder are looked for first and watched for changes.
+MYPY_CONFIG_FILES = ('mypy.ini', '.mypy.ini', 'pyproject.toml', 'setup.cfg')
+MYPY_USER_CONFIG_FILES = ('~/.config/mypy/config', '~/.mypy.ini')
+# Changes of these files in the environment change sys.path or compiled
+# modules
+ENVIRONMENT_FILES = ('.pth', '.egg-link', '.so', '.pyd')
+# Seconds a call hierarchy request may spend on resolving call sites by
+# Jedi, the rest are resolved in background
+CALL_CONFIRMATION_TIME = 0.2
+# Maximum number of top level packages imported in the workspace which are
+# loaded into Jedi caches
+WARM_UP_WORKSPACE_PACKAGES = 100
 
 
 _COMPLETION_TYPES = {
@@ -49,15 +97,46 @@ _COMPLETION_TYPES = {
 jedi_settings.case_insensitive_completion = False
 
 
-completionFunction: Callable[[List[Completion], types.Range],
-                             Iterator[types.CompletionItem]]
+completionFunction: Callable[[List[Completion], Dict], Iterator[Dict]]
 documentSymbolFunction: Union[
     Callable[[str, List[str], List[Name]], List[types.DocumentSymbol]],
     Callable[[str, List[str], List[Name]], List[types.SymbolInformation]]]
 
 
+def json_dumps(data: Any) -> bytes:
+    """Serialize data using orjson if it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=default_serializer)
+        except TypeError:
+            # e.g. namedtuple; let json turn it into list as it did before
+            pass
+    # Same output as orjson
+    return json.dumps(data, default=default_serializer, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
 class AnakinLanguageServerProtocol(LanguageServerProtocol):
 
+    def _send_data(self, data):
+        # Same as in LanguageServerProtocol, but with faster serialization
+        # and the body isn't formatted for logging unless it is logged
+        if not data:
+            return
+        try:
+            body = json_dumps(data)
+            if protocol_logger.isEnabledFor(logging.INFO):
+                protocol_logger.info('Sending data: %s',
+                                     body.decode(self.CHARSET))
+            header = (
+                f'Content-Length: {len(body)}\r\n'
+                f'Content-Type: {self.CONTENT_TYPE}; '
+                f'charset={self.CHARSET}\r\n\r\n'
+            ).encode(self.CHARSET)
+            self.transport.write(header + body)
+        except Exception:
+            protocol_logger.exception('Failed to send data')
+
     def bf_initialize(
             self, params: types.InitializeParams) -> types.InitializeResult:
         result = super().bf_initialize(params)
@@ -65,6 +144,8 @@ class AnakinLanguageServerProtocol(LanguageServerProtocol):
         global jediProject
         global completionFunction
         global documentSymbolFunction
+        global workerPool
+        global watchFiles
         venv = getattr(params.initializationOptions, 'venv', None)
         if venv:
             jediEnvironment = create_environment(venv, False)
@@ -77,6 +158,19 @@ class AnakinLanguageServerProtocol(LanguageServerProtocol):
             logging.info(f'  {p}')
         logging.info(f'Jedi project path: {jediProject._path}')
 
+        _run_in_background(_scan_workspace, _iter_workspace_files(
+            _get_workspace_folders(self)))
+        _run_in_background(callGraph.clear_inactive)
+
+        workers = _get_pool_size(params.initializationOptions)
+        if workers:
+            workerPool = create_pool(workers, _init_worker,
+                                     (self.workspace.root_uri,))
+        if workerPool:
+            logging.info(f'Worker pool size: {workers}')
+        _configure_scheduler(params.initializationOptions,
+                             workers if workerPool else 0)
+
         def get_attr(o, *attrs):
             try:
                 for attr in attrs:
@@ -85,6 +179,10 @@ class AnakinLanguageServerProtocol(LanguageServerProtocol):
             except AttributeError:
                 return None
 
+        watchFiles = bool(get_attr(params.capabilities, 'workspace',
+                                   'didChangeWatchedFiles',
+                                   'dynamicRegistration'))
+
         caps = getattr(params.capabilities, 'textDocument', None)
 
         if get_attr(caps, 'completion', 'completionItem', 'snippetSupport'):
@@ -107,6 +205,17 @@ class AnakinLanguageServerProtocol(LanguageServerProtocol):
             types.CodeActionKind.RefactorInline,
             types.CodeActionKind.RefactorExtract
         ])
+        # pygls does not currently support semantic tokens of LSP v3.16
+        result.capabilities.semanticTokensProvider = {
+            'legend': {
+                'tokenTypes': TOKEN_TYPES,
+                'tokenModifiers': TOKEN_MODIFIERS
+            },
+            'range': True,
+            'full': {'delta': True}
+        }
+        # Neither call hierarchy of LSP v3.16
+        result.capabilities.callHierarchyProvider = True
         # pygls does not currently support serverInfo of LSP v3.15
         result.serverInfo = {
             'name': 'anakinls',
@@ -120,23 +229,302 @@ server = LanguageServer(protocol_cls=AnakinLanguageServerProtocol)
 scripts: Dict[str, Script] = {}
 pycodestyleOptions: Dict[str, Any] = {}
 mypyConfigs: Dict[str, str] = {}
+# Documents waiting for mypy and the running check, one at a time
+mypyQueue: Deque[str] = deque()
+mypyTask: Optional[asyncio.Future] = None
+# Diagnostics of the last validation: jedi, pyflakes and mypy ones in
+# `diagnostics`, pycodestyle ones in `codestyleDiagnostics`
+diagnostics: Dict[str, List[Dict]] = {}
+codestyleDiagnostics: Dict[str, List[Dict]] = {}
+# Lines changed since pycodestyle diagnostics were updated
+codestyleChanges: Dict[str, Tuple[int, int]] = {}
+
+# Results of memoized requests and version of the document they are for
+requestResults: Dict[str, Tuple[int, Dict[Tuple, asyncio.Future]]] = {}
+requestResultsStats = {'hits': 0, 'misses': 0}
+# Number of requests waiting for every shared result
+requestWaiters: Dict[asyncio.Future, int] = {}
+
+# Semantic tokens of open documents
+semanticTokens: Dict[str, '_SemanticTokens'] = {}
+semanticTokensIds = itertools.count(1)
 
 jediEnvironment = None
 jediProject = None
+workerPool: Optional[WorkerPool] = None
+watchFiles = False
 
-config = {
+# Incremented whenever caches are invalidated by changes on disk.
+# Worker processes compare them with their own to drop stale Scripts.
+cacheGeneration = 0
+scriptGenerations: Dict[str, int] = {}
+environmentGeneration = 0
+
+config: Dict[str, Any] = {
     'pyflakes_errors': [
         'UndefinedName'
     ],
     'pycodestyle_config': None,
     'help_on_hover': True,
-    'mypy_enabled': False
+    'mypy_enabled': False,
+    'pycodestyle_on_change': True,
+    'completion_fuzzy': False,
+    'completion_max_items': 100
 }
 
 differ = Differ()
 
+scheduler = Scheduler(
+    workers={
+        Priority.INTERACTIVE: 1,
+        Priority.USER: 1,
+        Priority.BACKGROUND: 1
+    },
+    # Wait time in seconds after which warning is logged
+    budgets={
+        Priority.INTERACTIVE: 0.1,
+        Priority.USER: 0.5,
+        Priority.BACKGROUND: 5
+    }
+)
+
+# Modules imported by opened documents are loaded before packages
+# imported in the workspace
+warmUpModules: Deque[str] = deque()
+workspaceWarmUpModules: Deque[str] = deque()
+# Modules loaded or queued in `warmUpModules`
+warmedUpModules: Set[str] = set()
+# Top level packages queued in `workspaceWarmUpModules`
+workspaceWarmUpPackages: Set[str] = set()
+
+# Call sites of workspace files for call hierarchy
+callGraph = CallGraph(os.path.join(
+    jedi_settings.cache_directory,
+    f'anakinls-call-graph-{callgraph.INDEX_VERSION}'))
+# Call sites resolved by Jedi by path of the calling file
+callResolutions: Dict[str, Dict[Tuple[int, int], Optional[Target]]] = {}
+# Path, position and name of call sites to resolve in background
+callConfirmations: Deque[Tuple[str, int, int, str]] = deque()
+# Scripts of files with call sites resolved by Jedi
+callScripts: Dict[str, Optional[Script]] = {}
+# Files of modules by name, `None` if not found
+modulePaths: Dict[str, Optional[str]] = {}
+
+
+def _is_positive(
+        value: Any,
+        value_type: Union[Type[int], Tuple[Type[int], Type[float]]]) -> bool:
+    return (not isinstance(value, bool) and isinstance(value, value_type)
+            and value > 0)
+
+
+def _get_pool_size(options: Any) -> int:
+    """Return valid `workers` initialization option or 0."""
+    workers = getattr(options, 'workers', None)
+    if workers is None or workers == 0:
+        return 0
+    if not _is_positive(workers, int):
+        logging.warning(f'Invalid workers: {workers!r}')
+        return 0
+    return workers
+
+
+def _configure_scheduler(options: Any, pool_size: int):
+    """Set workers and budgets of priorities from initialization options.
+
+    Options are objects with `interactive`, `user` and `background`
+    keys. Invalid values are ignored.
+    """
+    if pool_size:
+        # Let sync requests run while all workers are busy
+        for priority in (Priority.INTERACTIVE, Priority.USER):
+            scheduler.workers[priority] = pool_size + 1
+    for option, values, value_type in (
+            ('scheduler_workers', scheduler.workers, int),
+            ('scheduler_budgets', scheduler.budgets, (int, float))):
+        option_values = getattr(options, option, None)
+        for priority in Priority:
+            name = priority.name.lower()
+            value = getattr(option_values, name, None)
+            if value is None:
+                continue
+            if not _is_positive(value, value_type):
+                logging.warning(f'Invalid {option}.{name}: {value!r}')
+                continue
+            values[priority] = value
+    # Requests would never be dispatched without workers
+    for priority in (Priority.INTERACTIVE, Priority.USER):
+        scheduler.workers[priority] = max(scheduler.workers[priority], 1)
+    logging.info('Scheduler workers and budgets: ' + ', '.join(
+        f'{priority.name.lower()}={scheduler.workers[priority]}/'
+        f'{scheduler.budgets[priority]}s'
+        for priority in Priority
+    ))
+
+
+def _feature(feature_name: str, priority: Priority, offload: bool = False,
+             memoize: bool = False, **options):
+    """Register feature which is executed by the scheduler.
+
+    If `offload` is set and worker pool is enabled, feature is executed
+    by a worker process. If `memoize` is set, result is shared by
+    requests for the same document version and position, including
+    requests made while it is computed. Decorated function itself is
+    returned as is.
+    """
+    def decorator(f):
+        def submit(ls: LanguageServer, params) -> asyncio.Future:
+            if offload and workerPool:
+                return scheduler.submit(priority, _run_in_pool,
+                                        f, ls, params)
+            return scheduler.submit(priority, f, ls, params)
+
+        @functools.wraps(f)
+        async def wrapper(ls: LanguageServer, params):
+            if memoize:
+                return await _memoized(feature_name, submit, ls, params)
+            return await submit(ls, params)
+        server.feature(feature_name, **options)(wrapper)
+        return f
+    return decorator
+
+
+def _forget_failed_result(results: Dict[Tuple, asyncio.Future], key: Tuple,
+                          future: asyncio.Future):
+    if future.cancelled() or future.exception() is not None:
+        if results.get(key) is future:
+            del results[key]
+
+
+async def _memoized(method: str, submit: Callable, ls: LanguageServer,
+                    params: Any) -> Any:
+    uri = params.textDocument.uri
+    version = ls.workspace.get_document(uri).version
+    if version is None:
+        return await submit(ls, params)
+    position = getattr(params, 'position', None)
+    key = (method, position and (position.line, position.character))
+    results_version, results = requestResults.get(uri, (None, {}))
+    if results_version != version:
+        results = {}
+        requestResults[uri] = (version, results)
+    future = results.get(key)
+    if future is None:
+        requestResultsStats['misses'] += 1
+        future = results[key] = submit(ls, params)
+        future.add_done_callback(
+            functools.partial(_forget_failed_result, results, key))
+    else:
+        requestResultsStats['hits'] += 1
+    logging.debug(f'{method} {uri}: memoized results '
+                  f'hits={requestResultsStats["hits"]}, '
+                  f'misses={requestResultsStats["misses"]}')
+    # Cancelled request must not cancel computation shared with others
+    requestWaiters[future] = requestWaiters.get(future, 0) + 1
+    try:
+        return await asyncio.shield(future)
+    finally:
+        requestWaiters[future] -= 1
+        if not requestWaiters[future]:
+            del requestWaiters[future]
+            # All requests were cancelled, don't run the queued job
+            future.cancel()
+
+
+def _to_dict(o: Any) -> Any:
+    # Params are namedtuples of dynamically created classes which can't
+    # be pickled
+    if hasattr(o, '_asdict'):
+        return {k: _to_dict(v) for k, v in o._asdict().items()}
+    if isinstance(o, list):
+        return [_to_dict(v) for v in o]
+    return o
+
+
+async def _run_in_pool(f: Callable, ls: LanguageServer, params: Any) -> Any:
+    assert workerPool is not None
+    uri = params.textDocument.uri
+    document = ls.workspace.get_document(uri)
+    try:
+        return await workerPool.run(uri, _call_in_worker, f, uri,
+                                    document.version, document.source,
+                                    _to_dict(params), config,
+                                    scriptGenerations.get(uri, 0),
+                                    environmentGeneration)
+    except BrokenProcessPool:
+        ls.show_message(f'{f.__name__} failed: worker process crashed',
+                        types.MessageType.Error)
+        # Failed result must not be memoized
+        raise
+
+
+class _WorkerServer:
+
+    def __init__(self, root_uri: str):
+        self.workspace = Workspace(root_uri, types.TextDocumentSyncKind.FULL)
+
+
+workerServer: Optional[_WorkerServer] = None
+# Versions and generations of documents Scripts are created for in the
+# worker process
+workerVersions: Dict[str, Tuple[Optional[int], int]] = {}
+
 
-def get_script(ls: LanguageServer, uri: str, update: bool = False) -> Script:
+def _init_worker(root_uri: str):
+    global workerServer
+    assert jediEnvironment is not None
+    subprocess = jediEnvironment._subprocess
+    if subprocess is not None:
+        # Compiled subprocess belongs to the server process. Don't kill
+        # it on cleanup and don't talk to it: Jedi will start a new one.
+        subprocess._cleanup_callable.detach()
+        subprocess.is_crashed = True
+    scripts.clear()
+    workerServer = _WorkerServer(root_uri)
+
+
+def _call_in_worker(f: Callable, uri: str, version: Optional[int],
+                    source: str, params: Dict, server_config: Dict,
+                    script_generation: int,
+                    environment_generation: int) -> Any:
+    global environmentGeneration
+    assert workerServer is not None
+    config.update(server_config)
+    if environment_generation != environmentGeneration:
+        _reset_jedi_environment()
+        workerVersions.clear()
+        environmentGeneration = environment_generation
+    if (version is None or
+            workerVersions.get(uri) != (version, script_generation)):
+        # Documents not opened by the client have no version
+        workerServer.workspace.put_document(types.TextDocumentItem(
+            uri, 'python', version, source))  # type: ignore
+        get_script(workerServer, uri, True)
+        workerVersions[uri] = (version, script_generation)
+    params = json.loads(json.dumps(params), object_hook=deserialize_message)
+    return f(workerServer, params)
+
+
+def _log_background_error(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error('Background job failed', exc_info=future.exception())
+
+
+def _run_in_background(fn: Callable, *args: Any, key: Any = None):
+    """Queue `fn(*args)` as a background job.
+
+    Long work is done one step per job, e.g. one file of the workspace
+    scan, and the job queues itself again for the rest, so requests
+    don't wait for all of it.
+    """
+    future = scheduler.submit(Priority.BACKGROUND, fn, *args, key=key)
+    # Job with the same key may be already queued
+    future.remove_done_callback(_log_background_error)
+    future.add_done_callback(_log_background_error)
+
+
+def get_script(ls: Union[LanguageServer, '_WorkerServer'], uri: str,
+               update: bool = False) -> Script:
     result = None if update else scripts.get(uri)
     if not result:
         document = ls.workspace.get_document(uri)
@@ -150,6 +538,174 @@ def get_script(ls: LanguageServer, uri: str, update: bool = False) -> Script:
     return result
 
 
+def _iter_imports(node) -> Iterator:
+    for child in node.children:
+        if child.type in ('import_name', 'import_from'):
+            yield child
+        elif hasattr(child, 'children'):
+            yield from _iter_imports(child)
+
+
+def _get_imported_modules(module_node) -> Iterator[str]:
+    # Module.iter_imports() doesn't look into functions and classes
+    for imp in _iter_imports(module_node):
+        if imp.level:
+            # Relative import
+            continue
+        if imp.type == 'import_from':
+            yield '.'.join(name.value for name in imp.get_from_names())
+        else:
+            for path in imp.get_paths():
+                yield '.'.join(name.value for name in path)
+
+
+def _warm_up(module_names: Iterable[str], workspace: bool = False):
+    """Load modules into Jedi caches in background.
+
+    Only top level packages of modules imported in the workspace are
+    loaded, up to WARM_UP_WORKSPACE_PACKAGES of them.
+    """
+    for name in module_names:
+        if workspace:
+            package = name.partition('.')[0]
+            if (package not in workspaceWarmUpPackages and
+                    len(workspaceWarmUpPackages) <
+                    WARM_UP_WORKSPACE_PACKAGES):
+                workspaceWarmUpPackages.add(package)
+                workspaceWarmUpModules.append(package)
+        elif name not in warmedUpModules:
+            warmedUpModules.add(name)
+            warmUpModules.append(name)
+    if warmUpModules or workspaceWarmUpModules:
+        _run_in_background(_warm_up_module, key='warm_up')
+
+
+def _warm_up_module():
+    name: Optional[str]
+    if warmUpModules:
+        name = warmUpModules.popleft()
+    else:
+        name = workspaceWarmUpModules.popleft()
+        if name in warmedUpModules:
+            # Already loaded for an opened document
+            name = None
+        else:
+            warmedUpModules.add(name)
+    if warmUpModules or workspaceWarmUpModules:
+        _run_in_background(_warm_up_module, key='warm_up')
+    if name is None:
+        return
+    # Same as jedi.preload_module but with our environment and project
+    code = f'import {name} as x; x.'
+    try:
+        Script(
+            code=code,
+            environment=jediEnvironment,
+            project=jediProject
+        ).complete(1, len(code))
+    except Exception:
+        logging.exception(f'Failed to warm up module {name}')
+
+
+def _get_workspace_folders(
+        ls: Union[LanguageServer, LanguageServerProtocol]) -> List[str]:
+    folders = [to_fs_path(f.uri) for f in ls.workspace.folders.values()]
+    if not folders and ls.workspace.root_path:
+        folders = [ls.workspace.root_path]
+    return folders
+
+
+def _iter_workspace_files(folders: List[str]) -> Iterator[str]:
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            # Skip hidden directories and virtualenvs
+            dirs[:] = [
+                d for d in dirs
+                if not d.startswith('.') and d != '__pycache__' and
+                not os.path.exists(os.path.join(root, d, 'pyvenv.cfg'))
+            ]
+            for filename in files:
+                if filename.endswith('.py'):
+                    yield os.path.join(root, filename)
+
+
+def _scan_workspace(files: Iterator[str]):
+    path = next(files, None)
+    if path is None:
+        return
+    _run_in_background(_scan_workspace, files)
+    file_index = _index_file(path)
+    if file_index is not None:
+        _warm_up(file_index['modules'], workspace=True)
+
+
+def _index_file(path: str, source: Optional[str] = None,
+                module_node=None) -> Optional[FileIndex]:
+    """Add call sites of the file to the call graph.
+
+    Index is loaded from the disk cache if the file was indexed before.
+    """
+    if source is None:
+        try:
+            with open(path) as f:
+                source = f.read()
+        except (OSError, UnicodeDecodeError):
+            callGraph.remove(path)
+            return None
+    content_hash = callgraph.get_hash(source)
+    old_index = callGraph.files.get(path)
+    if old_index is not None and old_index['hash'] == content_hash:
+        return old_index
+    file_index = callGraph.load(content_hash)
+    if file_index is None:
+        if module_node is None:
+            assert jediEnvironment is not None
+            module_node = jediEnvironment.get_grammar().parse(source)
+        file_index = callgraph.build_index(module_node)
+        file_index['modules'] = list(_get_imported_modules(module_node))
+        callGraph.save(content_hash, file_index)
+    callGraph.add(path, content_hash, file_index)
+    if old_index is not None:
+        # Resolved call sites may refer to the old version
+        callResolutions.clear()
+        callConfirmations.clear()
+        callScripts.clear()
+    return file_index
+
+
+def _get_file_index(path: str) -> Optional[FileIndex]:
+    # Index of an open document may be newer than the file
+    return callGraph.files.get(path) or _index_file(path)
+
+
+def _index_document(ls: LanguageServer, uri: str):
+    document = ls.workspace.get_document(uri)
+    _index_file(document.path, document.source,
+                get_script(ls, uri)._module_node)
+
+
+def _range(line: int, character: int,
+           end_line: int, end_character: int) -> Dict:
+    return {
+        'start': {'line': line, 'character': character},
+        'end': {'line': end_line, 'character': end_character}
+    }
+
+
+def _diagnostic(r: Dict, message: str, severity: types.DiagnosticSeverity,
+                source: str, code: Optional[str] = None) -> Dict:
+    # Results are built as dicts: serializing pygls types is slow
+    result = {
+        'range': r,
+        'message': message,
+        'severity': severity,
+        'source': source
+    }
+    if code:
+        result['code'] = code
+    return result
+
+
 class PyflakesReporter:
 
     def __init__(self, result, script, errors):
@@ -158,11 +714,11 @@ class PyflakesReporter:
         self.errors = errors
 
     def unexpectedError(self, _filename, msg):
-        self.result.append(types.Diagnostic(
-            types.Range(types.Position(), types.Position()),
+        self.result.append(_diagnostic(
+            _range(0, 0, 0, 0),
             msg,
             types.DiagnosticSeverity.Error,
-            source='pyflakes'
+            'pyflakes'
         ))
 
     def _get_codeline(self, line):
@@ -171,14 +727,11 @@ class PyflakesReporter:
     def syntaxError(self, _filename, msg, lineno, offset, _text):
         line = lineno - 1
         col = offset or 0
-        self.result.append(types.Diagnostic(
-            types.Range(
-                types.Position(line, col),
-                types.Position(line, len(self._get_codeline(line)) - col)
-            ),
+        self.result.append(_diagnostic(
+            _range(line, col, line, len(self._get_codeline(line)) - col),
             msg,
             types.DiagnosticSeverity.Error,
-            source='pyflakes'
+            'pyflakes'
         ))
 
     def flake(self, message):
@@ -187,14 +740,11 @@ class PyflakesReporter:
             severity = types.DiagnosticSeverity.Error
         else:
             severity = types.DiagnosticSeverity.Warning
-        self.result.append(types.Diagnostic(
-            types.Range(
-                types.Position(line, message.col),
-                types.Position(line, len(self._get_codeline(line)))
-            ),
+        self.result.append(_diagnostic(
+            _range(line, message.col, line, len(self._get_codeline(line))),
             message.message % message.message_args,
             severity,
-            source='pyflakes'
+            'pyflakes'
         ))
 
 
@@ -209,15 +759,15 @@ class CodestyleReport(CodestyleBaseReport):
         if self._ignore_code(code) or code in self.expected:
             return
         line = line_number - 1
-        self.result.append(types.Diagnostic(
-            types.Range(
-                types.Position(line, offset),
-                types.Position(line, len(self.lines[line].rstrip('\n\r')))
-            ),
+        row = self.line_offset + line
+        # Tokenizer errors may be reported past the last line
+        code_line = self.lines[line] if line < len(self.lines) else ''
+        self.result.append(_diagnostic(
+            _range(row, offset, row, len(code_line.rstrip('\n\r'))),
             text,
             types.DiagnosticSeverity.Warning,
-            code,
-            'pycodestyle'
+            'pycodestyle',
+            code
         ))
 
 
@@ -250,10 +800,8 @@ def get_mypy_config(ls: LanguageServer, uri: str) -> Optional[str]:
     folder = _get_workspace_folder_path(ls, uri)
     if folder in mypyConfigs:
         return mypyConfigs[folder]
-    import os
-    from mypy.defaults import CONFIG_FILES
     result = ''
-    for filename in CONFIG_FILES:
+    for filename in MYPY_CONFIG_FILES + MYPY_USER_CONFIG_FILES:
         filename = os.path.expanduser(filename)
         if not os.path.isabs(filename):
             filename = os.path.join(folder, filename)
@@ -264,13 +812,27 @@ def get_mypy_config(ls: LanguageServer, uri: str) -> Optional[str]:
     return result
 
 
-def _mypy_check(ls: LanguageServer, uri: str, script: Script,
-                result: List[types.Diagnostic]):
-    from mypy import api
+async def _run_mypy(args: List[str]) -> Tuple[str, str]:
+    # mypy runs in its own process, so the loop is free meanwhile
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'mypy', *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    return stdout.decode(), stderr.decode()
+
+
+async def _mypy_check(ls: LanguageServer, uri: str, script: Script,
+                      result: List[Dict]):
     assert jediEnvironment is not None
     version_info = jediEnvironment.version_info
     filename = to_fs_path(uri)
-    lines = api.run([
+    stdout, stderr = await _run_mypy([
         '--python-executable', jediEnvironment.executable,
         '--python-version', f'{version_info.major}.{version_info.minor}',
         '--config-file', get_mypy_config(ls, uri),
@@ -282,11 +844,11 @@ def _mypy_check(ls: LanguageServer, uri: str, script: Script,
         '--no-error-summary',
         filename
     ])
-    if lines[1]:
-        ls.show_message(lines[1], types.MessageType.Error)
+    if stderr:
+        ls.show_message(stderr, types.MessageType.Error)
         return
 
-    for line in lines[0].split('\n'):
+    for line in stdout.split('\n'):
         parts = line.split(':', 4)
         if len(parts) < 5:
             continue
@@ -300,75 +862,428 @@ def _mypy_check(ls: LanguageServer, uri: str, script: Script,
         else:
             severity = types.DiagnosticSeverity.Warning
         result.append(
-            types.Diagnostic(
-                types.Range(
-                    types.Position(row, column),
-                    types.Position(row, len(script._code_lines[row]))
-                ),
+            _diagnostic(
+                _range(row, column, row, len(script._code_lines[row])),
                 message.strip(),
                 severity,
-                source='mypy'
+                'mypy'
             )
         )
     return result
 
 
+def _publish_diagnostics(ls: LanguageServer, uri: str,
+                         diagnostics: List[Dict]):
+    # Diagnostics are dicts, not the pygls type of publish_diagnostics
+    ls.send_notification(TEXT_DOCUMENT_PUBLISH_DIAGNOSTICS,
+                         {'uri': uri, 'diagnostics': diagnostics})
+
+
 def _validate(ls: LanguageServer, uri: str):
+    """Check syntax and pyflakes, then queue pycodestyle and mypy.
+
+    Every checker is a background job of its own, so interactive
+    requests don't wait for all of them.
+    """
     # Jedi
     script = get_script(ls, uri)
     result = [
-        types.Diagnostic(
-            types.Range(
-                types.Position(x.line - 1, x.column),
-                types.Position(x.until_line - 1, x.until_column)
-            ),
+        _diagnostic(
+            _range(x.line - 1, x.column, x.until_line - 1, x.until_column),
             'Invalid syntax',
             types.DiagnosticSeverity.Error,
-            source='jedi'
+            'jedi'
         )
         for x in script.get_syntax_errors()
     ]
     if result:
-        ls.publish_diagnostics(uri, result)
+        diagnostics[uri] = result
+        codestyleDiagnostics.pop(uri, None)
+        codestyleChanges.pop(uri, None)
+        _publish_diagnostics(ls, uri, result)
         return
 
     # pyflakes
     pyflakes_check(script._code, script.path,
                    PyflakesReporter(result, script, config['pyflakes_errors']))
+    _run_in_background(_validate_codestyle, ls, uri,
+                       key=('validate_codestyle', uri))
+    if config['mypy_enabled']:
+        # Keep the last mypy diagnostics until it checks the file again
+        result.extend(d for d in diagnostics.get(uri, ())
+                      if d['source'] == 'mypy')
+        _queue_mypy(ls, uri)
+    diagnostics[uri] = result
+    _publish_diagnostics(ls, uri, result + codestyleDiagnostics.get(uri, []))
+
+
+def _is_validated(uri: str) -> bool:
+    # Diagnostics are dropped when the document is closed
+    return uri in diagnostics and not any(
+        d['source'] == 'jedi' for d in diagnostics[uri])
+
+
+def _validate_codestyle(ls: LanguageServer, uri: str):
+    if not _is_validated(uri):
+        return
+    codestyleChanges.pop(uri, None)
+    result: List[Dict] = []
+    _codestyle_check(ls, uri, get_script(ls, uri)._code.splitlines(True),
+                     result)
+    codestyleDiagnostics[uri] = result
+    _publish_diagnostics(ls, uri, diagnostics[uri] + result)
+
+
+def _queue_mypy(ls: LanguageServer, uri: str):
+    """Check the document by mypy when the previous check is done.
+
+    mypy is not a scheduler job: awaiting its process would keep the
+    background slot and delay all other background jobs.
+    """
+    if uri not in mypyQueue:
+        mypyQueue.append(uri)
+    _start_mypy(ls)
+
+
+def _start_mypy(ls: LanguageServer):
+    global mypyTask
+    if mypyTask is None and mypyQueue:
+        mypyTask = asyncio.ensure_future(
+            _validate_mypy(ls, mypyQueue.popleft()))
+        mypyTask.add_done_callback(functools.partial(_mypy_done, ls))
+
+
+def _mypy_done(ls: LanguageServer, task: asyncio.Future):
+    global mypyTask
+    mypyTask = None
+    _log_background_error(task)
+    _start_mypy(ls)
+
+
+async def _validate_mypy(ls: LanguageServer, uri: str):
+    if not _is_validated(uri):
+        return
+    result: List[Dict] = []
+    try:
+        await _mypy_check(ls, uri, get_script(ls, uri), result)
+    except Exception as e:
+        ls.show_message(f'mypy check error: {e}',
+                        types.MessageType.Warning)
+        return
+    # Document could change or be closed while mypy was running
+    if not _is_validated(uri):
+        return
+    result = [
+        d for d in diagnostics[uri] if d['source'] != 'mypy'
+    ] + result
+    diagnostics[uri] = result
+    _publish_diagnostics(ls, uri, result + codestyleDiagnostics.get(uri, []))
+
 
-    # pycodestyle
+def _codestyle_check(ls: LanguageServer, uri: str, lines: List[str],
+                     result: List[Dict], line_offset: int = 0,
+                     after_imports: bool = False):
+    """Check `lines` starting at `line_offset`.
+
+    If `after_imports` is set, lines are after the first statement which
+    is not an import, so their imports are reported as E402.
+    """
     codestyleopts = get_pycodestyle_options(ls, uri)
-    CodestyleChecker(
-        script.path, script._code.splitlines(True), codestyleopts,
+    checker = CodestyleChecker(
+        to_fs_path(uri), lines, codestyleopts,
         CodestyleReport(codestyleopts, result)
-    ).check_all()
+    )
+    if after_imports:
+        checker._checker_states[module_imports_on_top_of_file.__name__] = {
+            'seen_non_imports': True
+        }
+    checker.check_all(line_offset=line_offset)
+
+
+def _get_line_changes(
+        changes: List[types.TextDocumentContentChangeEvent]
+) -> List[Tuple[int, int, int]]:
+    """Return start, end and new end line of every change.
+
+    Replacement of the whole document is `(0, sys.maxsize, sys.maxsize)`.
+    """
+    result = []
+    for change in changes:
+        r = getattr(change, 'range', None)
+        if r is None:
+            result.append((0, sys.maxsize, sys.maxsize))
+        else:
+            start = r.start.line
+            result.append((start, r.end.line,
+                           start + change.text.count('\n')))
+    return result
+
+
+def _apply_line_changes(
+        line_changes: List[Tuple[int, int, int]],
+        diagnostic_lists: Iterable[List[Dict]],
+        changed: Optional[Tuple[int, int]] = None
+) -> Optional[Tuple[int, int]]:
+    """Shift diagnostics by the line delta of every change.
+
+    Return first and last changed lines of the new document including
+    previously `changed` lines.
+    """
+    region = changed
+    for start, end, new_end in line_changes:
+        delta = new_end - end
+
+        def shift(line: int) -> int:
+            if line < start:
+                return line
+            if line > end:
+                return line + delta
+            return min(line, new_end)
+
+        for diagnostic_list in diagnostic_lists:
+            for diagnostic in diagnostic_list:
+                diagnostic_range = diagnostic['range']
+                for position in (diagnostic_range['start'],
+                                 diagnostic_range['end']):
+                    position['line'] = shift(position['line'])
+        if region is None:
+            region = start, new_end
+        else:
+            region = (min(shift(region[0]), start),
+                      max(shift(region[1]), new_end))
+    return region
+
+
+def _get_codestyle_region(script: Script, first: int,
+                          last: int) -> Tuple[int, int, int]:
+    """Return lines to recheck after lines `first`..`last` were changed.
+
+    Region is extended to whole top level statements so logical lines
+    and indentation are not broken. One more statement is checked before
+    the region so blank lines checks have proper context. Return start of
+    the lines to check, start of the lines to report and end of the region.
+    """
+    starts = [child.start_pos[0] - 1
+              for child in script._module_node.children
+              if child.type != 'endmarker']
+    lines_count = len(script._code_lines)
+    idx = bisect_right(starts, first) - 1
+    if idx <= 0:
+        check_start = report_start = 0
+    else:
+        check_start = starts[idx - 1]
+        report_start = starts[idx]
+    # Statement after the changed lines is checked too as blank lines
+    # before it could be changed
+    idx = bisect_right(starts, last) + 1
+    end = starts[idx] if idx < len(starts) else lines_count
+    return check_start, report_start, end
+
+
+def _get_imports_end(script: Script) -> int:
+    """Return line of the first statement which is not an import.
+
+    Imports after it are reported as E402. Return `sys.maxsize` if there
+    is no such statement.
+    """
+    state: Dict[str, bool] = {}
+    for child in script._module_node.children:
+        if child.type in ('newline', 'endmarker'):
+            continue
+        # pycodestyle looks only at the start of logical lines
+        line = child.get_code(include_prefix=False).split('\n', 1)[0]
+        for _ in module_imports_on_top_of_file(line, 0, state, False):
+            pass
+        if state.get('seen_non_imports'):
+            return child.start_pos[0] - 1
+    return sys.maxsize
+
+
+def _recheck_codestyle(ls: LanguageServer, uri: str):
+    changed = codestyleChanges.pop(uri, None)
+    if changed is None or uri not in codestyleDiagnostics:
+        return
+    script = get_script(ls, uri)
+    lines = script._code.splitlines(True)
+    if changed[0] <= _get_imports_end(script):
+        # E402 of any import after the change may appear or disappear
+        check_start = report_start = 0
+        end = len(lines)
+    else:
+        check_start, report_start, end = _get_codestyle_region(
+            script, *changed)
+    truncated = end < len(lines)
+    # Diagnostics of deleted lines at the end were shifted past it.
+    # Blank lines and newline at the end of file are checked only if the
+    # region reaches it.
+    cached = [
+        d for d in codestyleDiagnostics[uri]
+        if (d['range']['start']['line'] < report_start or
+            truncated and d['range']['start']['line'] >= end) and
+        (truncated or d.get('code') not in ('W391', 'W292'))
+    ]
+    result: List[Dict] = []
+    _codestyle_check(ls, uri, lines[check_start:end], result, check_start,
+                     after_imports=report_start > 0)
+    cached.extend(
+        d for d in result
+        if d['range']['start']['line'] >= report_start and
+        not (truncated and d.get('code') == 'W391')
+    )
+    codestyleDiagnostics[uri] = cached
+    _publish_diagnostics(ls, uri, diagnostics[uri] + cached)
 
-    if config['mypy_enabled']:
-        try:
-            _mypy_check(ls, uri, script, result)
-        except Exception as e:
-            ls.show_message(f'mypy check error: {e}',
-                            types.MessageType.Warning)
 
-    ls.publish_diagnostics(uri, result)
+def _validate_open_document(ls: LanguageServer, uri: str):
+    # Document could be closed while the job was queued
+    if uri in ls.workspace.documents:
+        _validate(ls, uri)
+
+
+def _validate_later(ls: LanguageServer, uri: str):
+    _run_in_background(_validate_open_document, ls, uri,
+                       key=('validate', uri))
 
 
 @server.feature(TEXT_DOCUMENT_DID_OPEN)
 def did_open(ls: LanguageServer, params: types.DidOpenTextDocumentParams):
-    _validate(ls, params.textDocument.uri)
+    uri = params.textDocument.uri
+    _validate_later(ls, uri)
+    _warm_up(_get_imported_modules(get_script(ls, uri)._module_node))
 
 
 @server.feature(TEXT_DOCUMENT_DID_CLOSE)
 def did_close(ls: LanguageServer, params: types.DidCloseTextDocumentParams):
-    try:
-        del scripts[params.textDocument.uri]
-    except KeyError:
-        pass
+    uri = params.textDocument.uri
+    for cache in (scripts, diagnostics, codestyleDiagnostics,
+                  codestyleChanges, semanticTokens, requestResults):
+        cache.pop(uri, None)
 
 
 @server.feature(TEXT_DOCUMENT_DID_CHANGE)
 def did_change(ls: LanguageServer, params: types.DidChangeTextDocumentParams):
-    get_script(ls, params.textDocument.uri, True)
+    uri = params.textDocument.uri
+    get_script(ls, uri, True)
+    requestResults.pop(uri, None)
+    line_changes = _get_line_changes(params.contentChanges)
+    if uri in semanticTokens:
+        _shift_semantic_tokens(semanticTokens[uri], line_changes)
+    if config['pycodestyle_on_change'] and uri in codestyleDiagnostics:
+        changed = _apply_line_changes(
+            line_changes,
+            (codestyleDiagnostics[uri], diagnostics[uri]),
+            codestyleChanges.get(uri)
+        )
+        if changed is not None:
+            codestyleChanges[uri] = changed
+            _run_in_background(_recheck_codestyle, ls, uri,
+                               key=('codestyle', uri))
+
+
+class _SemanticTokens:
+
+    def __init__(self):
+        # Tokens of every line of the document
+        self.lines: List[List[semantic_tokens.Token]] = []
+        # Start lines and types of top level nodes
+        self.nodes: List[semantic_tokens.Node] = []
+        # Lines changed since tokens were updated
+        self.changed: Optional[Tuple[int, int]] = (0, sys.maxsize)
+        self.version: Optional[int] = None
+        self.result_id = ''
+        self.data: List[int] = []
+        # Edit of data made by the last update
+        self.edit: Tuple[int, int, List[int]] = (0, 0, [])
+
+
+def _shift_semantic_tokens(tokens: _SemanticTokens,
+                           line_changes: List[Tuple[int, int, int]]):
+    for start, end, new_end in line_changes:
+        if end == sys.maxsize:
+            tokens.lines.clear()
+            tokens.nodes.clear()
+            continue
+        tokens.lines[start:end + 1] = [
+            [] for _ in range(new_end - start + 1)
+        ]
+        delta = new_end - end
+        tokens.nodes = [
+            (line if line < start else line + delta, node_type)
+            for line, node_type in tokens.nodes if not start <= line <= end
+        ]
+    tokens.changed = _apply_line_changes(line_changes, (), tokens.changed)
+
+
+def _get_semantic_tokens(ls: LanguageServer, uri: str) -> _SemanticTokens:
+    """Return tokens of the current document version.
+
+    Only top level statements with changed lines are parsed for tokens.
+    """
+    tokens = semanticTokens.get(uri)
+    if tokens is None:
+        tokens = semanticTokens[uri] = _SemanticTokens()
+    version = ls.workspace.get_document(uri).version
+    if tokens.changed is None:
+        if tokens.version == version:
+            return tokens
+        # Document was changed without notification
+        _shift_semantic_tokens(tokens, [(0, sys.maxsize, sys.maxsize)])
+    assert tokens.changed is not None
+    script = get_script(ls, uri)
+    module_node = script._module_node
+    lines_count = len(script._code_lines)
+    start, end, nodes, tokens.nodes = semantic_tokens.get_region(
+        module_node, *tokens.changed, tokens.nodes)
+    if end is None:
+        end = lines_count
+    tokens.lines[start:end] = semantic_tokens.get_tokens(nodes, start, end)
+    if len(tokens.lines) == lines_count:
+        start, delete_count, data = semantic_tokens.get_edit(
+            tokens.data, tokens.lines, start, end)
+    else:
+        logging.warning(f'Semantic tokens of {uri} are out of sync')
+        tokens.lines = semantic_tokens.get_tokens(module_node.children,
+                                                  0, lines_count)
+        start = 0
+        delete_count = len(tokens.data)
+        data = semantic_tokens.encode(tokens.lines)
+    tokens.data = (tokens.data[:start] + data +
+                   tokens.data[start + delete_count:])
+    tokens.edit = (start, delete_count, data)
+    tokens.changed = None
+    tokens.version = version
+    tokens.result_id = str(next(semanticTokensIds))
+    return tokens
+
+
+@_feature('textDocument/semanticTokens/full', Priority.USER)
+def semantic_tokens_full(ls: LanguageServer, params) -> Dict:
+    tokens = _get_semantic_tokens(ls, params.textDocument.uri)
+    return {'resultId': tokens.result_id, 'data': tokens.data}
+
+
+@_feature('textDocument/semanticTokens/full/delta', Priority.USER)
+def semantic_tokens_delta(ls: LanguageServer, params) -> Dict:
+    previous = semanticTokens.get(params.textDocument.uri)
+    previous_id = previous and previous.result_id
+    tokens = _get_semantic_tokens(ls, params.textDocument.uri)
+    if params.previousResultId != previous_id:
+        return {'resultId': tokens.result_id, 'data': tokens.data}
+    edits = []
+    if tokens.result_id != previous_id:
+        start, delete_count, data = tokens.edit
+        edits.append({'start': start, 'deleteCount': delete_count,
+                      'data': data})
+    return {'resultId': tokens.result_id, 'edits': edits}
+
+
+@_feature('textDocument/semanticTokens/range', Priority.USER)
+def semantic_tokens_range(ls: LanguageServer, params) -> Dict:
+    tokens = _get_semantic_tokens(ls, params.textDocument.uri)
+    # Tokens of whole lines are returned
+    start = params.range.start.line
+    end = params.range.end.line + 1
+    return {'data': semantic_tokens.encode(tokens.lines[start:end], start)}
 
 
 def _completion_sort_key(completion: Completion) -> str:
@@ -380,36 +1295,97 @@ def _completion_sort_key(completion: Completion) -> str:
     return f'aa{name}'
 
 
-def _completion_item(completion: Completion, r: types.Range) -> Dict:
+def _fuzzy_match_bonus(name: str, prefix: str) -> Optional[int]:
+    """Return bonus of the best match of `prefix` characters in `name`.
+
+    Characters at start of words, e.g. after `_` or camel case hump,
+    and runs of consecutive characters get bonus; characters skipped
+    before and between matches are penalized.
+    """
+    lower = name.lower()
+    # Positions of the last matched character and best bonus of the
+    # prefix matched so far ending there
+    matches = [(-1, 0)]
+    for char in prefix.lower():
+        new_matches = []
+        j = lower.find(char, matches[0][0] + 1)
+        while j >= 0:
+            if (j == 0 or name[j - 1] == '_' or
+                    name[j].isupper() and name[j - 1].islower()):
+                bonus = 4
+            else:
+                bonus = 1
+            best = None
+            for k, score in matches:
+                if k >= j:
+                    break
+                if k == j - 1 and k >= 0:
+                    score += 2
+                else:
+                    score -= j - k - 1
+                if best is None or score > best:
+                    best = score
+            if best is not None:
+                new_matches.append((j, best + bonus))
+            j = lower.find(char, j + 1)
+        if not new_matches:
+            return None
+        matches = new_matches
+    return max(score for _, score in matches)
+
+
+def _completion_match_score(name: str, prefix: str) -> Tuple[int, int]:
+    if name.startswith(prefix):
+        return 0, 0
+    if name.lower().startswith(prefix.lower()):
+        return 1, 0
+    bonus = _fuzzy_match_bonus(name, prefix)
+    if bonus is None:
+        return 3, 0
+    return 2, -bonus
+
+
+def _rank_completions(completions: List[Completion], prefix: str,
+                      max_items: int) -> List[Completion]:
+    def key(completion: Completion):
+        return (_completion_match_score(completion.name, prefix),
+                _completion_sort_key(completion))
+    return heapq.nsmallest(max_items, completions, key=key)
+
+
+def _completion_item(completion: Completion, r: Dict) -> Dict:
     label = completion.name
-    if not completion.complete.startswith("'") and label.startswith("'"):
+    complete = completion.complete
+    if complete is None:
+        # Fuzzy completion replaces the whole typed word, the quote of a
+        # string isn't part of it
+        if label.startswith("'"):
+            label = label[1:]
+        complete = label
+    elif not complete.startswith("'") and label.startswith("'"):
         label = label[1:]
-    return dict(
-        label=label,
-        kind=_COMPLETION_TYPES.get(completion.type,
-                                   types.CompletionItemKind.Text),
-        documentation=completion.docstring(raw=True),
-        sort_text=_completion_sort_key(completion),
-        text_edit=types.TextEdit(r, completion.complete)
-    )
+    return {
+        'label': label,
+        'kind': _COMPLETION_TYPES.get(completion.type,
+                                      types.CompletionItemKind.Text),
+        'documentation': completion.docstring(raw=True),
+        'sortText': _completion_sort_key(completion),
+        'textEdit': {'range': r, 'newText': complete}
+    }
 
 
 def _completions(completions: List[Completion],
-                 r: types.Range) -> Iterator[types.CompletionItem]:
+                 r: Dict) -> Iterator[Dict]:
     return (
-        types.CompletionItem(
-            **_completion_item(completion, r)
-        ) for completion in completions
+        _completion_item(completion, r) for completion in completions
     )
 
 
 def _completions_snippets(completions: List[Completion],
-                          r: types.Range) -> Iterator[types.CompletionItem]:
+                          r: Dict) -> Iterator[Dict]:
     for completion in completions:
         item = _completion_item(completion, r)
-        yield types.CompletionItem(
-            **item
-        )
+        yield item
         for signature in completion.get_signatures():
             names = []
             snippets = []
@@ -430,39 +1406,61 @@ def _completions_snippets(completions: List[Completion],
                 )
             names_str = ', '.join(names)
             snippets_str = ', '.join(snippets)
-            yield types.CompletionItem(**dict(
+            snippet_item = dict(
                 item,
                 label=f'{completion.name}({names_str})',
-                insert_text=f'{completion.name}({snippets_str})$0',
-                insert_text_format=types.InsertTextFormat.Snippet,
-                text_edit=None
-            ))
+                insertText=f'{completion.name}({snippets_str})$0',
+                insertTextFormat=types.InsertTextFormat.Snippet
+            )
+            del snippet_item['textEdit']
+            yield snippet_item
 
 
-@server.feature(COMPLETION, trigger_characters=['.'])
-def completions(ls: LanguageServer, params: types.CompletionParams):
+@_feature(COMPLETION, Priority.INTERACTIVE, trigger_characters=['.'])
+def completions(ls: LanguageServer, params: types.CompletionParams) -> Dict:
     script = get_script(ls, params.textDocument.uri)
     completions = script.complete(
         params.position.line + 1,
-        params.position.character
+        params.position.character,
+        fuzzy=config['completion_fuzzy']
     )
     code_line = script._code_lines[params.position.line]
+    prefix_match = RE_WORD_END.search(code_line[:params.position.character])
+    prefix = prefix_match.group() if prefix_match else ''
+    total = len(completions)
+    max_items = config['completion_max_items']
+    is_incomplete = bool(max_items) and total > max_items
+    if is_incomplete:
+        # Client will request completions again as user types
+        completions = _rank_completions(completions, prefix, max_items)
     word_match = RE_WORD.match(code_line[params.position.character:])
     if word_match:
         word_rest = word_match.end()
     else:
         word_rest = 0
-    r = types.Range(
-        types.Position(params.position.line,
-                       params.position.character),
-        types.Position(params.position.line,
-                       params.position.character + word_rest)
-    )
-    return types.CompletionList(False,
-                                list(completionFunction(completions, r)))
+    start = params.position.character
+    if config['completion_fuzzy']:
+        start -= len(prefix)
+    r = _range(params.position.line, start,
+               params.position.line, params.position.character + word_rest)
+    items = list(completionFunction(completions, r))
+    if is_incomplete:
+        # Clients sort items by sortText, keep the rank of matches
+        for i, item in enumerate(items):
+            item['sortText'] = f'{i:05d}'
+    result = {
+        'isIncomplete': is_incomplete,
+        'items': items
+    }
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        size = len(json_dumps(result))
+        logging.debug(f'Completion: {len(completions)} of {total} '
+                      f'candidates, {len(items)} items, '
+                      f'{size} bytes')
+    return result
 
 
-@server.feature(HOVER)
+@_feature(HOVER, Priority.INTERACTIVE, offload=True, memoize=True)
 def hover(ls: LanguageServer,
           params: types.TextDocumentPositionParams) -> Optional[types.Hover]:
     script = get_script(ls, params.textDocument.uri)
@@ -476,7 +1474,8 @@ def hover(ls: LanguageServer,
     return None
 
 
-@server.feature(SIGNATURE_HELP, trigger_characters=['(', ','])
+@_feature(SIGNATURE_HELP, Priority.INTERACTIVE, memoize=True,
+          trigger_characters=['(', ','])
 def signature_help(
         ls: LanguageServer,
         params: types.TextDocumentPositionParams
@@ -508,47 +1507,365 @@ def signature_help(
     return None
 
 
-def _get_locations(defs: List[Name]) -> List[types.Location]:
+def _get_locations(defs: List[Name]) -> List[Dict]:
     return [
-        types.Location(
-            from_fs_path(d.module_path),
-            types.Range(
-                types.Position(d.line - 1, d.column),
-                types.Position(d.line - 1, d.column + len(d.name))
-            )
-        )
+        {
+            'uri': from_fs_path(str(d.module_path)),
+            'range': _range(d.line - 1, d.column,
+                            d.line - 1, d.column + len(d.name))
+        }
         for d in defs if d.module_path
     ]
 
 
-@server.feature(DEFINITION)
+@_feature(DEFINITION, Priority.USER, offload=True, memoize=True)
 def definition(
         ls: LanguageServer,
-        params: types.TextDocumentPositionParams) -> List[types.Location]:
+        params: types.TextDocumentPositionParams) -> List[Dict]:
     script = get_script(ls, params.textDocument.uri)
     defs = script.goto(params.position.line + 1, params.position.character)
     return _get_locations(defs)
 
 
-@server.feature(REFERENCES)
+@_feature(REFERENCES, Priority.USER, offload=True)
 def references(ls: LanguageServer,
-               params: types.ReferenceParams) -> List[types.Location]:
+               params: types.ReferenceParams) -> List[Dict]:
     script = get_script(ls, params.textDocument.uri)
     refs = script.get_references(params.position.line + 1,
                                  params.position.character)
     return _get_locations(refs)
 
 
+_CALL_HIERARCHY_KINDS = {
+    'module': types.SymbolKind.Module,
+    'class': types.SymbolKind.Class,
+    'function': types.SymbolKind.Function,
+    'method': types.SymbolKind.Method
+}
+
+
+def _find_module(name: str) -> Optional[str]:
+    if name not in modulePaths:
+        modulePaths[name] = None
+        for root in _get_sys_path():
+            base = os.path.join(root, *name.split('.'))
+            for path in (f'{base}.py', os.path.join(base, '__init__.py')):
+                if os.path.isfile(path):
+                    modulePaths[name] = path
+                    break
+            if modulePaths[name]:
+                break
+    return modulePaths[name]
+
+
+def _get_absolute_import(path: str, name: str) -> Optional[str]:
+    level = len(name) - len(name.lstrip('.'))
+    if not level:
+        return name
+    module_name = _get_module_name(path)
+    if module_name is None:
+        return None
+    package = module_name.split('.')
+    if os.path.basename(path) != '__init__.py':
+        package.pop()
+    if level > 1:
+        package = package[:1 - level]
+    return '.'.join(package + [name[level:]]) if name[level:] else None
+
+
+def _get_call_script(ls: LanguageServer, path: str) -> Optional[Script]:
+    if path not in callScripts:
+        # Positions of the index must match the code
+        content_hash = callGraph.files[path]['hash']
+        uri = from_fs_path(path)
+        document = ls.workspace.documents.get(uri)
+        if (document is not None and
+                callgraph.get_hash(document.source) == content_hash):
+            callScripts[path] = get_script(ls, uri)
+        else:
+            try:
+                with open(path) as f:
+                    code = f.read()
+            except (OSError, UnicodeDecodeError):
+                code = None
+            if code is None or callgraph.get_hash(code) != content_hash:
+                callScripts[path] = None
+            else:
+                callScripts[path] = Script(
+                    code=code,
+                    path=path,
+                    environment=jediEnvironment,
+                    project=jediProject
+                )
+    return callScripts[path]
+
+
+def _confirm_call(ls: LanguageServer, path: str, line: int, column: int,
+                  name: str) -> Optional[Target]:
+    """Resolve call site by Jedi to one of functions named `name`."""
+    candidates = callGraph.definitions(name)
+    result = None
+    script = _get_call_script(ls, path)
+    names = (script.goto(line + 1, column, follow_imports=True)
+             if script else [])
+    for definition in names:
+        if definition.module_path is None or definition.line is None:
+            continue
+        definition_path = str(definition.module_path)
+        file_index = callGraph.files.get(definition_path)
+        if file_index is None:
+            continue
+        qualname = callgraph.find_scope(
+            file_index, definition.line - 1, definition.column)
+        if qualname is not None and (definition_path, qualname) in candidates:
+            result = (definition_path, qualname)
+            break
+    callResolutions.setdefault(path, {})[(line, column)] = result
+    return result
+
+
+def _confirm_next_call(ls: LanguageServer):
+    if not callConfirmations:
+        # Index changed
+        return
+    path, line, column, name = callConfirmations.popleft()
+    if callConfirmations:
+        _run_in_background(_confirm_next_call, ls, key='confirm_calls')
+    if (path in callGraph.files and
+            (line, column) not in callResolutions.get(path, {})):
+        _confirm_call(ls, path, line, column, name)
+    _forget_call_scripts()
+
+
+def _forget_call_scripts():
+    # Inference state of Scripts may be big
+    if not callConfirmations:
+        callScripts.clear()
+
+
+class _CallResolver:
+    """Find functions called by call sites of the call graph.
+
+    Names defined in the same module, imported names and methods called
+    on `self` are resolved by the index, as are other names which are not
+    builtins and are defined once in the workspace. Jedi is asked about
+    the rest: methods called on other objects and names defined several
+    times. Call sites which can't be resolved in `CALL_CONFIRMATION_TIME`
+    are resolved in background and skipped.
+    """
+
+    def __init__(self, ls: LanguageServer):
+        self.ls = ls
+        self.deadline = time.monotonic() + CALL_CONFIRMATION_TIME
+        self.pending = 0
+
+    def _resolve_qualified(self, path: str, file_index: FileIndex,
+                           qualname: str) -> Tuple[bool, Optional[Target]]:
+        # Return whether name is known to the module and what it is
+        first, _, rest = qualname.partition('.')
+        if first in file_index['scopes']:
+            if qualname in file_index['scopes']:
+                return True, (path, qualname)
+            return False, None
+        imported = file_index['imports'].get(first)
+        if imported is None:
+            return False, None
+        full_name = _get_absolute_import(path, imported)
+        if full_name is None:
+            return False, None
+        if rest:
+            full_name = f'{full_name}.{rest}'
+        parts = full_name.split('.')
+        for i in range(len(parts) - 1, 0, -1):
+            module_path = _find_module('.'.join(parts[:i]))
+            if module_path is None:
+                continue
+            module_index = _get_file_index(module_path)
+            name = '.'.join(parts[i:])
+            if module_index is not None and name in module_index['scopes']:
+                return True, (module_path, name)
+            # Maybe imported from another module
+            return False, None
+        # Not a Python module, e.g. compiled one
+        return True, None
+
+    def resolve(self, path: str, file_index: FileIndex, qualname: str,
+                call: callgraph.Call) -> Optional[Target]:
+        """Return function called by `call` of scope `qualname`."""
+        name, receiver, line, column = call
+        dotted = None
+        if receiver is None:
+            dotted = name
+        elif receiver in ('self', 'cls'):
+            scopes = file_index['scopes']
+            class_name = qualname.rpartition('.')[0]
+            if scopes.get(class_name, {}).get('kind') == 'class':
+                dotted = f'{class_name}.{name}'
+        elif receiver != '?':
+            dotted = f'{receiver}.{name}'
+        if dotted is not None:
+            known, target = self._resolve_qualified(path, file_index, dotted)
+            if known:
+                return target
+        candidates = callGraph.definitions(name)
+        if not candidates:
+            return None
+        if receiver is None:
+            if hasattr(builtins, name):
+                return None
+            if len(candidates) == 1:
+                # Probably imported by `import *`
+                return next(iter(candidates))
+        # Receiver may be anything, e.g. `items.append()` calls a method
+        # of list, which is not indexed
+        resolutions = callResolutions.get(path, {})
+        if (line, column) in resolutions:
+            return resolutions[(line, column)]
+        if time.monotonic() < self.deadline:
+            return _confirm_call(self.ls, path, line, column, name)
+        self.pending += 1
+        callConfirmations.append((path, line, column, name))
+        _run_in_background(_confirm_next_call, self.ls, key='confirm_calls')
+        return None
+
+
+def _call_hierarchy_item(path: str, file_index: FileIndex,
+                         qualname: str) -> Dict:
+    scope = file_index['scopes'][qualname]
+    module_name = _get_module_name(path)
+    return {
+        'name': (qualname.rpartition('.')[2] or module_name or
+                 os.path.basename(path)),
+        'kind': _CALL_HIERARCHY_KINDS[scope['kind']],
+        'detail': module_name,
+        'uri': from_fs_path(path),
+        'range': _range(*scope['range']),
+        'selectionRange': _range(*scope['selection']),
+        'data': {'path': path, 'name': qualname}
+    }
+
+
+def _get_call_hierarchy_target(item) -> Optional[Target]:
+    data = getattr(item, 'data', None)
+    if data is not None:
+        return data.path, data.name
+    # Client didn't preserve data
+    path = to_fs_path(item.uri)
+    file_index = _get_file_index(path)
+    if file_index is None:
+        return None
+    start = item.selectionRange.start
+    qualname = callgraph.find_scope(file_index, start.line, start.character)
+    return (path, qualname) if qualname is not None else None
+
+
+def _call_range(call: callgraph.Call) -> Dict:
+    name, _, line, column = call
+    return _range(line, column, line, column + len(name))
+
+
+@_feature('textDocument/prepareCallHierarchy', Priority.USER)
+def prepare_call_hierarchy(ls: LanguageServer,
+                           params) -> Optional[List[Dict]]:
+    uri = params.textDocument.uri
+    script = get_script(ls, uri)
+    line = params.position.line + 1
+    column = params.position.character
+    leaf = script._module_node.get_name_of_position((line, column))
+    if (leaf is not None and leaf.parent.type in ('funcdef', 'classdef') and
+            leaf.parent.name is leaf):
+        document = ls.workspace.get_document(uri)
+        # Document may be not saved yet
+        _index_file(document.path, document.source, script._module_node)
+        definitions = [(document.path, leaf.line, leaf.column)]
+    else:
+        definitions = [
+            (str(name.module_path), name.line, name.column)
+            for name in script.goto(line, column, follow_imports=True)
+            if name.type in ('function', 'class') and name.module_path and
+            name.line is not None
+        ]
+    result = []
+    for path, line, column in definitions:
+        file_index = _get_file_index(path)
+        if file_index is None:
+            continue
+        qualname = callgraph.find_scope(file_index, line - 1, column)
+        if qualname is not None:
+            result.append(_call_hierarchy_item(path, file_index, qualname))
+    return result or None
+
+
+@_feature('callHierarchy/incomingCalls', Priority.USER)
+def incoming_calls(ls: LanguageServer, params) -> Optional[List[Dict]]:
+    target = _get_call_hierarchy_target(params.item)
+    if target is None:
+        return None
+    name = target[1].rpartition('.')[2]
+    resolver = _CallResolver(ls)
+    result = []
+    for path in sorted(callGraph.callers(name)):
+        file_index = callGraph.files[path]
+        for qualname, scope in file_index['scopes'].items():
+            ranges = [
+                _call_range(call) for call in scope['calls']
+                if call[0] == name and
+                resolver.resolve(path, file_index, qualname, call) == target
+            ]
+            if ranges:
+                result.append({
+                    'from': _call_hierarchy_item(path, file_index, qualname),
+                    'fromRanges': ranges
+                })
+    if resolver.pending:
+        logging.info(f'{resolver.pending} calls of {name} are resolved '
+                     'in background')
+    _forget_call_scripts()
+    return result
+
+
+@_feature('callHierarchy/outgoingCalls', Priority.USER)
+def outgoing_calls(ls: LanguageServer, params) -> Optional[List[Dict]]:
+    target = _get_call_hierarchy_target(params.item)
+    if target is None:
+        return None
+    path, qualname = target
+    file_index = _get_file_index(path)
+    if file_index is None or qualname not in file_index['scopes']:
+        return None
+    resolver = _CallResolver(ls)
+    calls: Dict[Target, List[Dict]] = {}
+    for call in file_index['scopes'][qualname]['calls']:
+        callee = resolver.resolve(path, file_index, qualname, call)
+        if callee is not None:
+            calls.setdefault(callee, []).append(_call_range(call))
+    if resolver.pending:
+        logging.info(f'{resolver.pending} calls of {qualname} are resolved '
+                     'in background')
+    _forget_call_scripts()
+    return [
+        {
+            'to': _call_hierarchy_item(
+                callee_path, callGraph.files[callee_path], callee_name),
+            'fromRanges': ranges
+        }
+        for (callee_path, callee_name), ranges in calls.items()
+    ]
+
+
 @server.feature(WORKSPACE_DID_CHANGE_CONFIGURATION)
 def did_change_configuration(ls: LanguageServer,
                              settings: types.DidChangeConfigurationParams):
     if not settings.settings or not hasattr(settings.settings, 'anakinls'):
         return
+    # e.g. hover depends on help_on_hover
+    requestResults.clear()
     changed = set()
     for k in config:
         if hasattr(settings.settings.anakinls, k):
             config[k] = getattr(settings.settings.anakinls, k)
-            if k != 'help_on_hover':
+            if k not in ('help_on_hover', 'completion_fuzzy',
+                         'completion_max_items'):
                 changed.add(k)
     if 'pycodestyle_config' in changed:
         pycodestyleOptions.clear()
@@ -556,7 +1873,192 @@ def did_change_configuration(ls: LanguageServer,
         mypyConfigs.clear()
     if changed:
         for uri in ls.workspace.documents:
-            _validate(ls, uri)
+            _validate_later(ls, uri)
+
+
+def _get_site_packages() -> List[str]:
+    assert jediEnvironment is not None
+    return [
+        path for path in jediEnvironment.get_sys_path()
+        if os.path.basename(path) in ('site-packages', 'dist-packages')
+    ]
+
+
+@server.feature(INITIALIZED)
+def initialized(ls: LanguageServer, params):
+    if not watchFiles:
+        return
+    config_files = ','.join(
+        sorted(set(CODESTYLE_PROJECT_CONFIG + MYPY_CONFIG_FILES)))
+    environment_files = ','.join(
+        ext[1:] for ext in ('.py', '.pyi') + ENVIRONMENT_FILES)
+    watchers = [
+        types.FileSystemWatcher('**/*.{py,pyi}'),
+        types.FileSystemWatcher(f'**/{{{config_files}}}')
+    ] + [
+        types.FileSystemWatcher(f'{path}/**/*.{{{environment_files}}}')
+        for path in _get_site_packages()
+    ]
+    ls.register_capability(types.RegistrationParams([types.Registration(
+        'anakinls-watched-files',
+        WORKSPACE_DID_CHANGE_WATCHED_FILES,
+        types.DidChangeWatchedFilesRegistrationOptions(watchers)
+    )]), None)
+
+
+def _is_subpath(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _get_sys_path() -> List[str]:
+    assert jediEnvironment is not None
+    return [str(jediProject._path)] + jediEnvironment.get_sys_path()
+
+
+def _get_module_name(path: str) -> Optional[str]:
+    roots = [p for p in _get_sys_path() if _is_subpath(path, p) and path != p]
+    if not roots:
+        return None
+    names = os.path.splitext(
+        path[len(max(roots, key=len)):].lstrip(os.sep))[0].split(os.sep)
+    if names[-1] == '__init__':
+        names.pop()
+    return '.'.join(names)
+
+
+def _get_loaded_paths(script: Script) -> Set[str]:
+    # Modules Jedi has loaded while inferring names of the script
+    result = set()
+    module_cache = script._inference_state.module_cache
+    for values in module_cache._name_cache.values():
+        for value in values:
+            path = value.py__file__()
+            if path:
+                result.add(str(path))
+    return result
+
+
+def _is_related_module(name: str, other: str) -> bool:
+    # Module, its package or its submodule
+    return (name == other or name.startswith(f'{other}.') or
+            other.startswith(f'{name}.'))
+
+
+def _invalidate_modules(ls: LanguageServer, paths: Set[str]) -> Set[str]:
+    """Forget modules changed on disk.
+
+    Scripts of open documents which loaded or import them are dropped.
+    Return uris of these documents.
+    """
+    global cacheGeneration
+    for modules in parser_cache.values():
+        for path in paths:
+            # Keys are str or Path depending on parso version
+            modules.pop(path, None)
+            modules.pop(Path(path), None)
+    names = set(filter(None, map(_get_module_name, paths)))
+    result = set()
+    for uri in ls.workspace.documents:
+        script = scripts.get(uri)
+        if script is None:
+            continue
+        if (paths & _get_loaded_paths(script) or
+                any(_is_related_module(name, imported)
+                    for imported in _get_imported_modules(script._module_node)
+                    for name in names)):
+            result.add(uri)
+    if result:
+        cacheGeneration += 1
+    for uri in result:
+        scripts.pop(uri, None)
+        requestResults.pop(uri, None)
+        scriptGenerations[uri] = cacheGeneration
+    # Load new versions of warmed up modules
+    warm_up = names & warmedUpModules
+    warmedUpModules.difference_update(warm_up)
+    _warm_up(sorted(warm_up))
+    return result
+
+
+def _invalidate_config(ls: LanguageServer, path: str) -> Set[str]:
+    """Forget pycodestyle and mypy configuration affected by the file.
+
+    Return uris of open documents using this configuration.
+    """
+    directory, filename = os.path.split(path)
+    folders = set()
+    if filename in CODESTYLE_PROJECT_CONFIG:
+        # pycodestyle looks for configuration in parent directories too
+        for folder in list(pycodestyleOptions):
+            if _is_subpath(folder, directory):
+                del pycodestyleOptions[folder]
+                folders.add(folder)
+    if filename in MYPY_CONFIG_FILES and directory in mypyConfigs:
+        del mypyConfigs[directory]
+        if config['mypy_enabled']:
+            folders.add(directory)
+    return {
+        uri for uri in ls.workspace.documents
+        if _get_workspace_folder_path(ls, uri) in folders
+    }
+
+
+def _reset_jedi_environment():
+    """Forget sys.path and compiled modules of the Jedi environment."""
+    assert jediEnvironment is not None
+    # Environment.get_sys_path() is memoized
+    jediEnvironment.__dict__.pop('_memoize_method_dct', None)
+    subprocess = jediEnvironment._subprocess
+    if subprocess is not None and not subprocess.is_crashed:
+        # Jedi starts a new one on the next request
+        subprocess._kill()
+    # All Scripts use the killed subprocess
+    scripts.clear()
+    requestResults.clear()
+    modulePaths.clear()
+    callScripts.clear()
+
+
+def _update_call_graph(ls: LanguageServer, paths: Set[str]):
+    # Modules may be created or deleted
+    modulePaths.clear()
+    folders = _get_workspace_folders(ls)
+    for path in paths:
+        if path in callGraph.files or (
+                path.endswith('.py') and
+                any(_is_subpath(path, folder) for folder in folders)):
+            _run_in_background(_index_file, path, key=('index', path))
+
+
+@server.feature(WORKSPACE_DID_CHANGE_WATCHED_FILES)
+def did_change_watched_files(ls: LanguageServer,
+                             params: types.DidChangeWatchedFiles):
+    global environmentGeneration
+    paths = {to_fs_path(change.uri) for change in params.changes}
+    validate = set()
+    modules = set()
+    environment_changed = False
+    for path in paths:
+        if path.endswith(ENVIRONMENT_FILES):
+            environment_changed = True
+        elif path.endswith(('.py', '.pyi')):
+            modules.add(path)
+        else:
+            validate |= _invalidate_config(ls, path)
+    if environment_changed:
+        logging.info('Jedi environment changed')
+        _reset_jedi_environment()
+        environmentGeneration += 1
+        if config['mypy_enabled']:
+            validate.update(ls.workspace.documents)
+    if modules:
+        dependent = _invalidate_modules(ls, modules)
+        # Only mypy checks imported modules
+        if config['mypy_enabled']:
+            validate |= dependent
+        _update_call_graph(ls, modules)
+    for uri in validate:
+        _validate_later(ls, uri)
 
 
 @server.feature(TEXT_DOCUMENT_WILL_SAVE)
@@ -566,7 +2068,9 @@ def will_save(ls: LanguageServer, params: types.WillSaveTextDocumentParams):
 
 @server.feature(TEXT_DOCUMENT_DID_SAVE)
 def did_save(ls: LanguageServer, params: types.DidSaveTextDocumentParams):
-    _validate(ls, params.textDocument.uri)
+    _validate_later(ls, params.textDocument.uri)
+    _run_in_background(_index_document, ls, params.textDocument.uri,
+                       key=('index', params.textDocument.uri))
 
 
 _DOCUMENT_SYMBOL_KINDS = {
@@ -647,7 +2151,7 @@ def _document_symbol_plain(
     return list(_symbols())
 
 
-@server.feature(DOCUMENT_SYMBOL)
+@_feature(DOCUMENT_SYMBOL, Priority.USER, memoize=True)
 def document_symbol(
         ls: LanguageServer, params: types.DocumentSymbolParams
 ) -> Union[List[types.DocumentSymbol], List[types.SymbolInformation], None]:
@@ -728,7 +2232,7 @@ def _get_document_changes(
     return result
 
 
-@server.feature(CODE_ACTION)
+@_feature(CODE_ACTION, Priority.USER, offload=True)
 def code_action(
         ls: LanguageServer, params: types.CodeActionParams
 ) -> Optional[List[types.CodeAction]]:
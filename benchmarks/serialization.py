@@ -0,0 +1,91 @@
+"""Compare serialization of pygls types with plain dicts.
+
+Usage: python benchmarks/serialization.py [ITEMS]
+"""
+import json
+import sys
+import timeit
+
+from pygls import types
+from pygls.protocol import JsonRPCResponseMessage, default_serializer
+
+from anakinls import server
+
+
+def completion_types(n: int) -> JsonRPCResponseMessage:
+    r = types.Range(types.Position(10, 4), types.Position(10, 8))
+    return JsonRPCResponseMessage(1, '2.0', types.CompletionList(False, [
+        types.CompletionItem(
+            label=f'name_{i}',
+            kind=types.CompletionItemKind.Function,
+            documentation=f'name_{i}(a, b)\n\nDocumentation of name_{i}',
+            sort_text=f'aaname_{i}',
+            text_edit=types.TextEdit(r, f'name_{i}')
+        ) for i in range(n)
+    ]), None).without_none_fields()
+
+
+def completion_dicts(n: int) -> JsonRPCResponseMessage:
+    r = server._range(10, 4, 10, 8)
+    return JsonRPCResponseMessage(1, '2.0', {
+        'isIncomplete': False,
+        'items': [
+            {
+                'label': f'name_{i}',
+                'kind': types.CompletionItemKind.Function,
+                'documentation': f'name_{i}(a, b)\n\n'
+                                 f'Documentation of name_{i}',
+                'sortText': f'aaname_{i}',
+                'textEdit': {'range': r, 'newText': f'name_{i}'}
+            } for i in range(n)
+        ]
+    }, None).without_none_fields()
+
+
+def diagnostics_types(n: int) -> types.PublishDiagnosticsParams:
+    return types.PublishDiagnosticsParams('file:///a.py', [
+        types.Diagnostic(
+            types.Range(types.Position(i, 0), types.Position(i, 80)),
+            'E501 line too long (100 > 79 characters)',
+            types.DiagnosticSeverity.Warning,
+            'E501',
+            'pycodestyle'
+        ) for i in range(n)
+    ])
+
+
+def diagnostics_dicts(n: int) -> types.PublishDiagnosticsParams:
+    return types.PublishDiagnosticsParams('file:///a.py', [
+        server._diagnostic(
+            server._range(i, 0, i, 80),
+            'E501 line too long (100 > 79 characters)',
+            types.DiagnosticSeverity.Warning,
+            'pycodestyle',
+            'E501'
+        ) for i in range(n)
+    ])
+
+
+def pygls_dumps(data) -> bytes:
+    return json.dumps(data, default=default_serializer).encode('utf-8')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    backend = 'orjson' if server.orjson else 'json'
+    print(f'{n} items, fast path JSON backend: {backend}')
+    for name, build_types, build_dicts in (
+            ('completion', completion_types, completion_dicts),
+            ('diagnostics', diagnostics_types, diagnostics_dicts)):
+        current = min(timeit.repeat(
+            lambda: pygls_dumps(build_types(n)), number=10, repeat=5)) / 10
+        fast = min(timeit.repeat(
+            lambda: server.json_dumps(build_dicts(n)),
+            number=10, repeat=5)) / 10
+        print(f'{name}: types + pygls encoder {current * 1000:.2f}ms, '
+              f'dicts + {backend} {fast * 1000:.2f}ms, '
+              f'{current / fast:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import json
+import os
+import sys
+
+import pytest
+
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import jedi
+import parso
+
+from anakinls import cache
+from anakinls.__main__ import main
+from parso.cache import _get_hashed_path, parser_cache
+
+VERSION = f'{sys.version_info.major}.{sys.version_info.minor}'
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'cache'
+    monkeypatch.setattr(cache.jedi_settings, 'cache_directory', str(path))
+    return path
+
+
+def _pickle_path(cache_dir, path, version=VERSION):
+    grammar = parso.load_grammar(version=version)
+    return _get_hashed_path(grammar._hashed, str(path), cache_path=cache_dir)
+
+
+def test_parse(tmp_path, cache_dir):
+    path = tmp_path / 'mod.py'
+    path.write_text('x = 1\n')
+    _, content_hash, status = cache._parse(str(path), None, VERSION)
+    assert status == 'parsed'
+    pickle_path = _pickle_path(cache_dir, path)
+    assert os.path.exists(pickle_path)
+
+    assert cache._parse(str(path), content_hash, VERSION) == (
+        str(path), content_hash, 'skipped')
+
+    # File is saved again with the same content
+    os.utime(pickle_path, (0, 0))
+    assert cache._parse(str(path), content_hash, VERSION)[2] == 'skipped'
+    assert os.path.getmtime(pickle_path) >= os.path.getmtime(path)
+
+    path.write_text('x = 2\n')
+    _, new_hash, status = cache._parse(str(path), content_hash, VERSION)
+    assert status == 'parsed'
+    assert new_hash != content_hash
+
+    os.remove(pickle_path)
+    assert cache._parse(str(path), new_hash, VERSION)[2] == 'parsed'
+
+    assert cache._parse(str(tmp_path / 'missing.py'), None, VERSION) == (
+        str(tmp_path / 'missing.py'), None, 'failed')
+
+
+@pytest.fixture
+def src(tmp_path, monkeypatch):
+    """Return workspace folder, the environment has empty sys.path."""
+    environment = Mock(
+        executable=sys.executable,
+        version_info=SimpleNamespace(major=sys.version_info.major,
+                                     minor=sys.version_info.minor)
+    )
+    environment.get_sys_path.return_value = []
+    monkeypatch.setattr(cache, 'get_default_environment',
+                        lambda: environment)
+    monkeypatch.setattr(cache, 'TYPESHED_PATH', tmp_path / 'typeshed')
+    (tmp_path / 'typeshed').mkdir()
+    path = tmp_path / 'src'
+    path.mkdir()
+    return path
+
+
+def test_warm_cache(src, cache_dir, capsys):
+    (src / '.hidden').mkdir()
+    (src / '.hidden' / 'skip.py').write_text('x = 1\n')
+    (src / 'a.py').write_text('a = 1\n')
+    (src / 'b.pyi').write_text('b: int\n')
+    (src / 'c.txt').write_text('c\n')
+
+    cache.warm_cache(None, [str(src)], 1)
+    assert 'parsed 2, skipped 0, failed 0' in capsys.readouterr().out
+    manifest_path = cache_dir / f'anakinls-warm-cache-{VERSION}.json'
+    manifest = json.loads(manifest_path.read_text())
+    assert sorted(manifest) == [str(src / 'a.py'), str(src / 'b.pyi')]
+
+    (src / 'a.py').write_text('a = 2\n')
+    cache.warm_cache(None, [str(src)], 1)
+    assert 'parsed 1, skipped 1, failed 0' in capsys.readouterr().out
+    new_manifest = json.loads(manifest_path.read_text())
+    assert new_manifest[str(src / 'b.pyi')] == manifest[str(src / 'b.pyi')]
+    assert new_manifest[str(src / 'a.py')] != manifest[str(src / 'a.py')]
+
+
+def test_warm_cache_stubs(src, cache_dir, monkeypatch):
+    # Grammar of this version differs from the one of the environment
+    monkeypatch.setattr(cache, '_get_stub_grammar_version',
+                        lambda environment: '3.7')
+    stub = cache.TYPESHED_PATH / 'os.pyi'
+    stub.write_text('sep: str\n')
+    (src / 'a.py').write_text('a = 1\n')
+    (src / 'b.pyi').write_text('b: int\n')
+
+    cache.warm_cache(None, [str(src)], 1)
+    assert os.path.exists(_pickle_path(cache_dir, src / 'a.py'))
+    for path in (src / 'b.pyi', stub):
+        assert os.path.exists(_pickle_path(cache_dir, path, '3.7'))
+        assert not os.path.exists(_pickle_path(cache_dir, path))
+
+
+def test_stub_grammar_version():
+    version = cache._get_stub_grammar_version(jedi.get_default_environment())
+    jedi.Script('import os\nos.sep').infer(2, 4)
+    stubs = parser_cache[parso.load_grammar(version=version)._hashed]
+    assert any(str(path).endswith('.pyi') for path in stubs)
+
+
+@pytest.mark.parametrize('jobs', ['0', '-1', 'x'])
+def test_warm_cache_jobs(jobs, monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv',
+                        ['anakinls', 'warm-cache', '--jobs', jobs])
+    with pytest.raises(SystemExit):
+        main()
+    assert 'must be a positive integer' in capsys.readouterr().err
@@ -0,0 +1,26 @@
+import os
+
+import parso
+
+from anakinls.callgraph import CallGraph, build_index
+
+
+def test_clear_inactive(tmp_path):
+    graph = CallGraph(str(tmp_path))
+    index = build_index(parso.parse('def foo():\n    pass\n'))
+    for content_hash in ('old', 'used', 'loaded', 'recent'):
+        graph.save(content_hash, index)
+    (tmp_path / 'interrupted.json.123').write_text('{')
+    for name in ('old.json', 'used.json', 'loaded.json',
+                 'interrupted.json.123'):
+        os.utime(tmp_path / name, (0, 0))
+    graph.add('/src/used.py', 'used', index)
+    assert graph.load('loaded') is not None
+
+    graph.clear_inactive()
+    assert sorted(os.listdir(tmp_path)) == [
+        'loaded.json', 'recent.json', 'used.json']
+
+
+def test_clear_inactive_without_cache(tmp_path):
+    CallGraph(str(tmp_path / 'missing')).clear_inactive()
@@ -0,0 +1,99 @@
+import asyncio
+
+from anakinls.scheduler import Priority, Scheduler
+
+
+def test_priority_order():
+    scheduler = Scheduler(
+        workers={priority: 1 for priority in Priority},
+        budgets={priority: 1 for priority in Priority}
+    )
+    calls = []
+
+    async def run():
+        futures = [
+            scheduler.submit(Priority.BACKGROUND, calls.append, 'validate',
+                             key='validate'),
+            scheduler.submit(Priority.BACKGROUND, calls.append, 'validate',
+                             key='validate'),
+            scheduler.submit(Priority.USER, calls.append, 'references'),
+            scheduler.submit(Priority.INTERACTIVE, calls.append, 'completion')
+        ]
+        assert futures[0] is futures[1]
+        await asyncio.gather(*futures)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert calls == ['completion', 'references', 'validate']
+
+
+def _scheduler(background_workers=1):
+    workers = {priority: 1 for priority in Priority}
+    workers[Priority.BACKGROUND] = background_workers
+    return Scheduler(workers=workers,
+                     budgets={priority: 1 for priority in Priority})
+
+
+def test_coroutine_keeps_worker():
+    scheduler = _scheduler()
+    calls = []
+
+    async def check(release):
+        calls.append('check started')
+        await release
+        calls.append('check done')
+
+    async def run():
+        release = asyncio.get_event_loop().create_future()
+        check_future = scheduler.submit(Priority.BACKGROUND, check, release)
+        validate = scheduler.submit(Priority.BACKGROUND, calls.append,
+                                    'validate')
+        await asyncio.sleep(0.01)
+        # Awaiting coroutine keeps the only background worker
+        assert calls == ['check started']
+        # Other priorities have workers of their own
+        await scheduler.submit(Priority.INTERACTIVE, calls.append,
+                               'completion')
+        release.set_result(None)
+        await asyncio.gather(check_future, validate)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert calls == ['check started', 'completion', 'check done',
+                     'validate']
+
+
+def test_coroutine_workers_limit():
+    scheduler = _scheduler(background_workers=2)
+    running = []
+    max_running = []
+
+    async def job():
+        running.append(None)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def run():
+        await asyncio.gather(*(
+            scheduler.submit(Priority.BACKGROUND, job) for _ in range(5)))
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert max(max_running) == 2
+
+
+def test_cancel_coroutine_frees_worker():
+    scheduler = _scheduler()
+    calls = []
+
+    async def wait(never):
+        await never
+
+    async def run():
+        never = asyncio.get_event_loop().create_future()
+        future = scheduler.submit(Priority.BACKGROUND, wait, never)
+        await asyncio.sleep(0.01)
+        future.cancel()
+        await scheduler.submit(Priority.BACKGROUND, calls.append, 'validate')
+        assert never.cancelled()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert calls == ['validate']
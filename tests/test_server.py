@@ -1,3 +1,12 @@
+import asyncio
+import json
+import os
+import sys
+
+from collections import deque
+
+import jedi
+import parso
 import pytest
 
 from unittest.mock import Mock
@@ -5,6 +14,8 @@ from unittest.mock import Mock
 from anakinls import server as aserver
 
 from pygls import types
+from pygls.protocol import deserialize_message
+from pygls.uris import from_fs_path
 from pygls.workspace import Document, Workspace
 
 
@@ -20,6 +31,31 @@ class Server():
 server = Server()
 
 
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """Return folder of the server workspace with a Jedi project."""
+    monkeypatch.setattr(aserver, 'jediEnvironment',
+                        jedi.get_default_environment())
+    monkeypatch.setattr(aserver, 'jediProject', jedi.Project(str(tmp_path)))
+    monkeypatch.setattr(server, 'workspace',
+                        Workspace(from_fs_path(str(tmp_path)), None))
+    yield tmp_path
+    root_uri = from_fs_path(str(tmp_path))
+    for uri in list(aserver.scripts):
+        if uri.startswith(root_uri):
+            del aserver.scripts[uri]
+
+
+def _put_document(path, source=None):
+    """Open document of the file `path`, return its uri."""
+    uri = from_fs_path(str(path))
+    if source is None:
+        source = path.read_text()
+    server.workspace.put_document(
+        types.TextDocumentItem(uri, 'python', 1, source))
+    return uri
+
+
 def test_completion():
     uri = 'file://test_completion.py'
     content = '''
@@ -37,16 +73,16 @@ foo'''
             types.Position(4, 3),
             types.CompletionContext(types.CompletionTriggerKind.Invoked)
         ))
-    assert len(completion.items) == 2
-    item = completion.items[0]
-    assert item.insertText is None
-    assert item.label == 'foo'
-    assert item.sortText == 'aafoo'
-    assert item.insertTextFormat is None
-    item = completion.items[1]
-    assert item.label == 'foo(a, b)'
-    assert item.insertTextFormat == types.InsertTextFormat.Snippet
-    assert item.insertText == 'foo(${1:a}, b=${2:b})$0'
+    assert len(completion['items']) == 2
+    item = completion['items'][0]
+    assert 'insertText' not in item
+    assert item['label'] == 'foo'
+    assert item['sortText'] == 'aafoo'
+    assert 'insertTextFormat' not in item
+    item = completion['items'][1]
+    assert item['label'] == 'foo(a, b)'
+    assert item['insertTextFormat'] == types.InsertTextFormat.Snippet
+    assert item['insertText'] == 'foo(${1:a}, b=${2:b})$0'
 
 
 def test_hover():
@@ -66,3 +102,889 @@ foo'''
     assert isinstance(h.contents, types.MarkupContent)
     assert h.contents.kind == types.MarkupKind.PlainText
     assert h.contents.value == 'foo(a, *, b, c=None)\n\ndocstring'
+
+
+def _codestyle_diagnostics(uri):
+    return sorted(
+        (d['range']['start']['line'], d['range']['start']['character'],
+         d['code'])
+        for d in aserver.codestyleDiagnostics[uri]
+    )
+
+
+def _validate(uri):
+    aserver._validate(server, uri)
+    aserver._validate_codestyle(server, uri)
+
+
+def _check_codestyle_change(uri, content, change):
+    """Return pycodestyle diagnostics updated incrementally and by full
+    check after `change`."""
+    doc = Document(uri, content)
+    server.workspace.get_document = Mock(return_value=doc)
+    server.send_notification = Mock()
+    aserver.get_script(server, uri, True)
+    _validate(uri)
+    doc.apply_change(change)
+    aserver.did_change(server, types.DidChangeTextDocumentParams(
+        types.VersionedTextDocumentIdentifier(uri, 1), [change]))
+    aserver._recheck_codestyle(server, uri)
+    incremental = _codestyle_diagnostics(uri)
+    _validate(uri)
+    return incremental, _codestyle_diagnostics(uri)
+
+
+def _insert_lines(line, text):
+    return types.TextDocumentContentChangeEvent(
+        types.Range(types.Position(line, 0), types.Position(line, 0)),
+        text=text
+    )
+
+
+def test_codestyle_on_change():
+    uri = 'file://test_codestyle_on_change.py'
+    content = '''import os
+
+
+def foo(a):
+    return a+1
+
+
+def bar(b):
+    return b
+
+
+class Baz:
+    x=1
+'''
+    change = types.TextDocumentContentChangeEvent(
+        types.Range(types.Position(7, 0), types.Position(8, 0)),
+        text='def bar(b) :\n\n    b=2\n'
+    )
+    incremental, full = _check_codestyle_change(uri, content, change)
+    assert incremental == full
+    assert full == [(7, 10, 'E203'), (9, 5, 'E225'), (14, 5, 'E225')]
+
+    # E402 depends on statements before the changed lines
+    imports = 'import os\n\nimport sys\n\nimport re\n'
+    incremental, full = _check_codestyle_change(
+        uri, imports, _insert_lines(0, 'x = 1\n'))
+    assert incremental == full
+    assert (5, 0, 'E402') in full
+    incremental, full = _check_codestyle_change(
+        uri, 'x = 1\n' + imports,
+        types.TextDocumentContentChangeEvent(
+            types.Range(types.Position(0, 0), types.Position(1, 0)),
+            text=''
+        ))
+    assert incremental == full == []
+    incremental, full = _check_codestyle_change(
+        uri, 'x = 1\nimport os\n\nimport sys\n',
+        _insert_lines(4, 'import re\n'))
+    assert incremental == full
+    assert (4, 0, 'E402') in full
+
+    incremental, full = _check_codestyle_change(
+        uri, 'import os\nx = 1\nimport re\n',
+        types.TextDocumentContentChangeEvent(
+            types.Range(types.Position(1, 0), types.Position(3, 0)),
+            text=''
+        ))
+    assert incremental == full == []
+
+    # W391 depends on the end of file
+    incremental, full = _check_codestyle_change(
+        uri, 'x = 1\n\n', _insert_lines(2, 'y = 2\n'))
+    assert incremental == full == []
+
+
+@pytest.fixture
+def validated(tmp_path, monkeypatch):
+    """Return function which validates document with mypy faked."""
+    monkeypatch.setattr(server, 'send_notification', Mock(),
+                        raising=False)
+    monkeypatch.setitem(aserver.config, 'mypy_enabled', True)
+    monkeypatch.setattr(aserver, 'jediEnvironment',
+                        jedi.get_default_environment())
+    monkeypatch.setattr(aserver, 'get_mypy_config', lambda ls, uri: '')
+    monkeypatch.setattr(aserver, 'mypyQueue', deque())
+    monkeypatch.setattr(aserver, 'mypyTask', None)
+    documents = {}
+    monkeypatch.setattr(server.workspace, 'get_document',
+                        lambda uri: documents[uri])
+    jobs = []
+    monkeypatch.setattr(aserver, '_run_in_background',
+                        lambda fn, *args, key: jobs.append(fn))
+    mypy_runs = []
+
+    async def run_mypy(args):
+        future = asyncio.get_event_loop().create_future()
+        mypy_runs.append((args[-1], future))
+        path = await future
+        return f'{path}:1:3: error: Fake  [misc]\n', ''
+
+    monkeypatch.setattr(aserver, '_run_mypy', run_mypy)
+
+    def validate(name, source):
+        uri = from_fs_path(str(tmp_path / name))
+        documents[uri] = Document(uri, source)
+        aserver.get_script(server, uri, True)
+        aserver._validate(server, uri)
+        return uri
+
+    validate.jobs = jobs
+    validate.mypy_runs = mypy_runs
+    yield validate
+    for uri in documents:
+        for cache in (aserver.scripts, aserver.diagnostics,
+                      aserver.codestyleDiagnostics):
+            cache.pop(uri, None)
+
+
+def _published():
+    return sorted(d.get('code') or d['source']
+                  for d in server.send_notification.call_args[0][1][
+                      'diagnostics'])
+
+
+def _finish_mypy(validated):
+    path, future = validated.mypy_runs[-1]
+    future.set_result(path)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(aserver.mypyTask)
+    # Let the next check start
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_validate_jobs(validated):
+    async def run():
+        return validated('main.py', 'x=undefined\n')
+
+    uri = asyncio.get_event_loop().run_until_complete(run())
+    # pycodestyle is a job of its own, mypy runs in a task
+    assert validated.jobs == [aserver._validate_codestyle]
+    assert _published() == ['pyflakes']
+    aserver._validate_codestyle(server, uri)
+    assert _published() == ['E225', 'pyflakes']
+    _finish_mypy(validated)
+    assert _published() == ['E225', 'mypy', 'pyflakes']
+
+
+def test_validate_keeps_mypy_diagnostics(validated):
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        return validated('main.py', 'x = 1\n')
+
+    uri = loop.run_until_complete(run())
+    _finish_mypy(validated)
+    assert _published() == ['mypy']
+    # Until mypy checks the file again
+    loop.run_until_complete(run())
+    assert _published() == ['mypy']
+    assert aserver.mypyTask is not None
+    _finish_mypy(validated)
+    assert [run[0] for run in validated.mypy_runs] == [
+        aserver.to_fs_path(uri)] * 2
+
+
+def test_validate_mypy_one_at_a_time(validated):
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        uris = [validated(name, 'x = 1\n')
+                for name in ('a.py', 'b.py', 'b.py', 'a.py')]
+        await asyncio.sleep(0)
+        return uris
+
+    a, b = loop.run_until_complete(run())[:2]
+    assert len(validated.mypy_runs) == 1
+    # Changed while checked, so checked again
+    assert list(aserver.mypyQueue) == [b, a]
+    _finish_mypy(validated)
+    _finish_mypy(validated)
+    _finish_mypy(validated)
+    assert [run[0] for run in validated.mypy_runs] == [
+        aserver.to_fs_path(uri) for uri in (a, b, a)]
+    assert aserver.mypyTask is None
+    assert not aserver.mypyQueue
+
+
+def test_validate_syntax_error(validated):
+    loop = asyncio.get_event_loop()
+
+    async def run(source):
+        return validated('main.py', source)
+
+    uri = loop.run_until_complete(run('x = 1\n'))
+    uri = loop.run_until_complete(run('x = (\n'))
+    assert _published() == ['jedi']
+    # Checkers queued before don't publish their diagnostics
+    aserver._validate_codestyle(server, uri)
+    _finish_mypy(validated)
+    assert _published() == ['jedi']
+
+
+def test_configure_scheduler(monkeypatch):
+    monkeypatch.setattr(aserver.scheduler, 'workers',
+                        dict(aserver.scheduler.workers))
+    monkeypatch.setattr(aserver.scheduler, 'budgets',
+                        dict(aserver.scheduler.budgets))
+    options = json.loads(json.dumps({
+        'scheduler_workers': {'user': 3, 'background': 0},
+        'scheduler_budgets': {'interactive': 0.05, 'background': 'x'}
+    }), object_hook=deserialize_message)
+    aserver._configure_scheduler(options, 2)
+    assert aserver.scheduler.workers == {
+        aserver.Priority.INTERACTIVE: 3,
+        aserver.Priority.USER: 3,
+        aserver.Priority.BACKGROUND: 1
+    }
+    assert aserver.scheduler.budgets == {
+        aserver.Priority.INTERACTIVE: 0.05,
+        aserver.Priority.USER: 0.5,
+        aserver.Priority.BACKGROUND: 5
+    }
+
+
+@pytest.mark.parametrize('workers, expected', [
+    (None, 0), (0, 0), (-1, 0), ('2', 0), (True, 0), (1.5, 0), (2, 2)
+])
+def test_pool_size(workers, expected):
+    options = json.loads(json.dumps({'workers': workers}),
+                         object_hook=deserialize_message)
+    assert aserver._get_pool_size(options) == expected
+
+
+def test_configure_scheduler_keeps_request_workers(monkeypatch):
+    monkeypatch.setattr(aserver.scheduler, 'workers',
+                        {priority: 0 for priority in aserver.Priority})
+    aserver._configure_scheduler(None, 0)
+    assert aserver.scheduler.workers[aserver.Priority.INTERACTIVE] == 1
+    assert aserver.scheduler.workers[aserver.Priority.USER] == 1
+
+
+def test_mypy_config(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setattr(server, 'workspace',
+                        Workspace(from_fs_path(str(tmp_path)), None))
+    monkeypatch.setattr(aserver, 'mypyConfigs', {})
+    uri = from_fs_path(str(tmp_path / 'main.py'))
+    assert aserver.get_mypy_config(server, uri) == ''
+    (tmp_path / 'home').mkdir()
+    (tmp_path / 'home' / '.mypy.ini').write_text('[mypy]\n')
+    # Configuration is cached until a watched file changes
+    assert aserver.get_mypy_config(server, uri) == ''
+    (tmp_path / 'setup.cfg').write_text('[mypy]\n')
+    aserver._invalidate_config(server, str(tmp_path / 'setup.cfg'))
+    assert aserver.get_mypy_config(server, uri) == str(tmp_path / 'setup.cfg')
+    os.remove(tmp_path / 'setup.cfg')
+    aserver._invalidate_config(server, str(tmp_path / 'setup.cfg'))
+    assert aserver.get_mypy_config(server, uri) == str(
+        tmp_path / 'home' / '.mypy.ini')
+
+
+def _send_data(data):
+    protocol = aserver.AnakinLanguageServerProtocol(Mock())
+    protocol.transport = Mock()
+    protocol._send_data(data)
+    return protocol.transport.write.call_args[0][0]
+
+
+def test_send_data_without_orjson(monkeypatch, caplog):
+    pytest.importorskip('orjson')
+    location = types.Location('file:///ő.py', aserver._range(0, 0, 0, 1))
+    data = {
+        'jsonrpc': '2.0',
+        'id': 1,
+        'result': [location, {'uri': 'file:///ő.py', 'range': None}]
+    }
+    caplog.set_level('INFO', logger=aserver.protocol_logger.name)
+    expected = _send_data(data)
+    monkeypatch.setattr(aserver, 'orjson', None)
+    assert _send_data(data) == expected
+    body = expected.split(b'\r\n\r\n', 1)[1]
+    assert json.loads(body)['result'][1]['uri'] == 'file:///ő.py'
+    assert caplog.messages == [f'Sending data: {body.decode()}'] * 2
+
+
+def test_imported_modules():
+    module_node = parso.parse('''
+import os.path, json as j
+from collections import abc
+from . import sibling
+from .pkg import mod
+
+def foo():
+    import numpy.linalg
+''')
+    assert list(aserver._get_imported_modules(module_node)) == [
+        'os.path', 'json', 'collections', 'numpy.linalg'
+    ]
+
+
+def test_warm_up_order(monkeypatch):
+    for name, value in (('warmUpModules', deque()),
+                        ('workspaceWarmUpModules', deque()),
+                        ('warmedUpModules', set()),
+                        ('workspaceWarmUpPackages', set()),
+                        ('WARM_UP_WORKSPACE_PACKAGES', 3)):
+        monkeypatch.setattr(aserver, name, value)
+    monkeypatch.setattr(aserver, '_run_in_background',
+                        lambda fn, *args, key=None: None)
+    script = Mock()
+    monkeypatch.setattr(aserver, 'Script', script)
+
+    aserver._warm_up(['numpy.linalg', 'numpy', 'os.path', 'json', 'sys',
+                      're'], workspace=True)
+    aserver._warm_up(['os.path', 'collections'])
+    aserver._warm_up(['os', 'collections.abc'], workspace=True)
+    loaded = []
+    while aserver.warmUpModules or aserver.workspaceWarmUpModules:
+        script.reset_mock()
+        aserver._warm_up_module()
+        if script.called:
+            loaded.append(script.call_args[1]['code'].split()[1])
+    # Imports of opened documents go first, workspace imports are
+    # limited to top level packages
+    assert loaded == ['os.path', 'collections', 'numpy', 'os', 'json']
+    # Already loaded package is not loaded again for workspace
+    aserver._warm_up(['collections'])
+    aserver._warm_up(['json.decoder'], workspace=True)
+    assert not aserver.warmUpModules
+    assert not aserver.workspaceWarmUpModules
+
+
+def test_completion_max_items(monkeypatch):
+    uri = 'file://test_completion_max_items.py'
+    content = '''
+class Foo:
+    def _bar(self):
+        pass
+
+    def bar(self):
+        pass
+
+    def baz(self):
+        pass
+
+Foo().'''
+    doc = Document(uri, content)
+    server.workspace.get_document = Mock(return_value=doc)
+    aserver.completionFunction = aserver._completions
+    monkeypatch.setitem(aserver.config, 'completion_max_items', 2)
+    completion = aserver.completions(
+        server,
+        types.CompletionParams(
+            types.TextDocumentIdentifier(uri),
+            types.Position(11, 6),
+            types.CompletionContext(types.CompletionTriggerKind.Invoked)
+        ))
+    assert completion['isIncomplete']
+    assert [(item['label'], item['sortText'])
+            for item in completion['items']] == [
+        ('bar', '00000'), ('baz', '00001')]
+
+
+def test_completion_fuzzy_rank(monkeypatch):
+    uri = 'file://test_completion_fuzzy_rank.py'
+    content = '''
+class Foo:
+    def gavel(self):
+        pass
+
+    def grove(self):
+        pass
+
+    def get_value(self):
+        pass
+
+    def get_version(self):
+        pass
+
+Foo().gv'''
+    doc = Document(uri, content)
+    server.workspace.get_document = Mock(return_value=doc)
+    aserver.completionFunction = aserver._completions
+    monkeypatch.setitem(aserver.config, 'completion_fuzzy', True)
+    monkeypatch.setitem(aserver.config, 'completion_max_items', 2)
+    completion = aserver.completions(
+        server,
+        types.CompletionParams(
+            types.TextDocumentIdentifier(uri),
+            types.Position(14, 8),
+            types.CompletionContext(types.CompletionTriggerKind.Invoked)
+        ))
+    assert completion['isIncomplete']
+    # Words starting with the typed characters are better than
+    # alphabetically earlier `gavel` and `grove`
+    assert [(item['label'], item['sortText'])
+            for item in completion['items']] == [
+        ('get_value', '00000'), ('get_version', '00001')]
+    # Fuzzy match replaces the typed word
+    assert completion['items'][0]['textEdit'] == {
+        'range': aserver._range(14, 6, 14, 8),
+        'newText': 'get_value'
+    }
+    assert (aserver._completion_match_score('getValue', 'gv') <
+            aserver._completion_match_score('get_value', 'gv') <
+            aserver._completion_match_score('gavel', 'gv') <
+            aserver._completion_match_score('grove', 'gv'))
+    assert (aserver._completion_match_score('zabc_helper', 'abc') <
+            aserver._completion_match_score('a_xbx_c', 'abc'))
+
+
+def _decode_semantic_tokens(data):
+    line = column = 0
+    result = []
+    for i in range(0, len(data), 5):
+        delta_line, delta_column, length, token_type, modifiers = \
+            data[i:i + 5]
+        if delta_line:
+            line += delta_line
+            column = 0
+        column += delta_column
+        result.append((line, column, length,
+                       aserver.TOKEN_TYPES[token_type], modifiers))
+    return result
+
+
+def test_semantic_tokens():
+    uri = 'file://test_semantic_tokens.py'
+    content = '''import os  # comment
+
+
+def foo(a):
+    return os.path.join(a, 'b')
+'''
+    doc = Document(uri, content, version=1,
+                   sync_kind=types.TextDocumentSyncKind.INCREMENTAL)
+    server.workspace.get_document = Mock(return_value=doc)
+    aserver.get_script(server, uri, True)
+    full = aserver.semantic_tokens_full(
+        server, Mock(textDocument=types.TextDocumentIdentifier(uri)))
+    assert _decode_semantic_tokens(full['data']) == [
+        (0, 0, 6, 'keyword', 0),
+        (0, 7, 2, 'namespace', 0),
+        (0, 11, 9, 'comment', 0),
+        (3, 0, 3, 'keyword', 0),
+        (3, 4, 3, 'function', 1),
+        (3, 8, 1, 'parameter', 1),
+        (4, 4, 6, 'keyword', 0),
+        (4, 11, 2, 'variable', 0),
+        (4, 14, 4, 'property', 0),
+        (4, 19, 4, 'method', 0),
+        (4, 24, 1, 'variable', 0),
+        (4, 27, 3, 'string', 0),
+    ]
+
+    change = types.TextDocumentContentChangeEvent(
+        types.Range(types.Position(3, 0), types.Position(3, 0)),
+        text='x = 1\n'
+    )
+    doc.apply_change(change)
+    doc.version = 2
+    aserver.did_change(server, types.DidChangeTextDocumentParams(
+        types.VersionedTextDocumentIdentifier(uri, 2), [change]))
+    delta = aserver.semantic_tokens_delta(server, Mock(
+        textDocument=types.TextDocumentIdentifier(uri),
+        previousResultId=full['resultId']))
+    assert delta['resultId'] != full['resultId']
+    data = list(full['data'])
+    for edit in delta['edits']:
+        data[edit['start']:edit['start'] + edit['deleteCount']] = \
+            edit['data']
+    assert _decode_semantic_tokens(data) == (
+        _decode_semantic_tokens(full['data'])[:3] + [
+            (3, 0, 1, 'variable', 1),
+            (3, 4, 1, 'number', 0),
+        ] + [
+            (line + 1, column, length, token_type, modifiers)
+            for line, column, length, token_type, modifiers
+            in _decode_semantic_tokens(full['data'])[3:]
+        ]
+    )
+    aserver.did_close(server, types.DidCloseTextDocumentParams(
+        types.TextDocumentIdentifier(uri)))
+
+
+def test_semantic_tokens_indented_first_line():
+    uri = 'file://test_semantic_tokens_indented_first_line.py'
+    doc = Document(uri, '    x = 1\ny = 2\n', version=1,
+                   sync_kind=types.TextDocumentSyncKind.INCREMENTAL)
+    server.workspace.get_document = Mock(return_value=doc)
+    aserver.get_script(server, uri, True)
+    identifier = types.TextDocumentIdentifier(uri)
+    full = aserver.semantic_tokens_full(server, Mock(textDocument=identifier))
+    assert _decode_semantic_tokens(full['data']) == [
+        (0, 4, 1, 'variable', 1),
+        (0, 8, 1, 'number', 0),
+        (1, 0, 1, 'variable', 1),
+        (1, 4, 1, 'number', 0),
+    ]
+
+    change = _insert_lines(1, 'z = 3\n')
+    doc.apply_change(change)
+    doc.version = 2
+    aserver.did_change(server, types.DidChangeTextDocumentParams(
+        types.VersionedTextDocumentIdentifier(uri, 2), [change]))
+    delta = aserver.semantic_tokens_delta(server, Mock(
+        textDocument=identifier, previousResultId=full['resultId']))
+    data = list(full['data'])
+    for edit in delta['edits']:
+        data[edit['start']:edit['start'] + edit['deleteCount']] = \
+            edit['data']
+    assert [token[0] for token in _decode_semantic_tokens(data)] == [
+        0, 0, 1, 1, 2, 2
+    ]
+    tokens = aserver.semantic_tokens_range(server, Mock(
+        textDocument=identifier,
+        range=types.Range(types.Position(1, 0), types.Position(1, 5))))
+    assert len(tokens['data']) == 10
+    aserver.did_close(server, types.DidCloseTextDocumentParams(identifier))
+
+
+@pytest.fixture
+def validated_later(monkeypatch):
+    result = []
+    monkeypatch.setattr(aserver, '_validate_later',
+                        lambda ls, uri: result.append(uri))
+    return result
+
+
+def _files_changed(*events):
+    aserver.did_change_watched_files(server, types.DidChangeWatchedFiles([
+        types.FileEvent(from_fs_path(str(path)), change_type)
+        for path, change_type in events
+    ]))
+
+
+def test_watched_module_changed(workspace, validated_later):
+    (workspace / 'dep.py').write_text('def foo():\n    pass\n')
+    main_uri = _put_document(workspace / 'main.py', 'import dep\ndep.foo\n')
+    other_uri = _put_document(workspace / 'other.py', 'import os\n')
+    aserver.get_script(server, main_uri).infer(2, 5)
+    aserver.get_script(server, other_uri)
+    _files_changed((workspace / 'dep.py', types.FileChangeType.Changed))
+    assert main_uri not in aserver.scripts
+    assert other_uri in aserver.scripts
+    # Only mypy checks imported modules
+    assert validated_later == []
+
+
+def test_watched_config_changed(workspace, validated_later, monkeypatch):
+    monkeypatch.setattr(aserver, 'pycodestyleOptions', {
+        str(workspace): Mock(),
+        '/elsewhere': Mock()
+    })
+    uris = [_put_document(workspace / name, 'import os\n')
+            for name in ('main.py', 'other.py')]
+    _files_changed((workspace / 'setup.cfg', types.FileChangeType.Created))
+    assert list(aserver.pycodestyleOptions) == ['/elsewhere']
+    assert sorted(validated_later) == sorted(uris)
+
+
+def test_memoized_requests():
+    uri = 'file://test_memoized_requests.py'
+    doc = Document(uri, 'x = 1\n', version=1)
+    server.workspace.get_document = Mock(return_value=doc)
+    loop = asyncio.get_event_loop()
+    calls = []
+
+    def submit(ls, params):
+        calls.append(params.position.line)
+        future = loop.create_future()
+        loop.call_soon(future.set_result, params.position.line)
+        return future
+
+    def params(line):
+        return types.TextDocumentPositionParams(
+            types.TextDocumentIdentifier(uri), types.Position(line, 0))
+
+    async def run():
+        results = await asyncio.gather(*(
+            aserver._memoized('hover', submit, server, params(line))
+            for line in (0, 0, 1)
+        ))
+        assert results == [0, 0, 1]
+        assert await aserver._memoized('hover', submit, server,
+                                       params(0)) == 0
+        doc.version = 2
+        assert await aserver._memoized('hover', submit, server,
+                                       params(0)) == 0
+
+    hits = aserver.requestResultsStats['hits']
+    misses = aserver.requestResultsStats['misses']
+    loop.run_until_complete(run())
+    aserver.requestResults.pop(uri)
+    assert calls == [0, 1, 0]
+    assert aserver.requestResultsStats['hits'] == hits + 2
+    assert aserver.requestResultsStats['misses'] == misses + 3
+
+
+@pytest.fixture
+def memoized(monkeypatch):
+    """Return function which memoizes hover of the document with
+    results computed by futures in its `futures` list."""
+    uri = 'file://test_memoized.py'
+    doc = Document(uri, 'x = 1\n', version=1)
+    monkeypatch.setattr(server.workspace, 'get_document',
+                        Mock(return_value=doc))
+    loop = asyncio.get_event_loop()
+    futures = []
+
+    def submit(ls, params):
+        futures.append(loop.create_future())
+        return futures[-1]
+
+    params = types.TextDocumentPositionParams(
+        types.TextDocumentIdentifier(uri), types.Position(0, 0))
+
+    def request():
+        return asyncio.ensure_future(
+            aserver._memoized('hover', submit, server, params))
+
+    request.futures = futures
+    yield request
+    aserver.requestResults.pop(uri, None)
+
+
+def test_memoized_requests_cancelled(memoized):
+    async def run():
+        first, second = memoized(), memoized()
+        await asyncio.sleep(0)
+        assert len(memoized.futures) == 1
+        first.cancel()
+        await asyncio.sleep(0)
+        # Another request still waits for the result
+        assert not memoized.futures[0].cancelled()
+        second.cancel()
+        await asyncio.sleep(0)
+        assert memoized.futures[0].cancelled()
+        assert not aserver.requestWaiters
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_memoized_requests_failed(memoized):
+    async def run():
+        request = memoized()
+        await asyncio.sleep(0)
+        memoized.futures[0].set_exception(RuntimeError())
+        with pytest.raises(RuntimeError):
+            await request
+        # Failed result is computed again
+        request = memoized()
+        await asyncio.sleep(0)
+        memoized.futures[1].set_result('result')
+        assert await request == 'result'
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert len(memoized.futures) == 2
+
+
+def _position_params(uri, line, character):
+    # Params of requests are namedtuples
+    return json.loads(json.dumps({
+        'textDocument': {'uri': uri},
+        'position': {'line': line, 'character': character},
+        'context': {'includeDeclaration': True}
+    }), object_hook=deserialize_message)
+
+
+def test_worker_params():
+    params = _position_params('file:///main.py', 1, 1)
+    # Params are sent to workers as dicts
+    round_trip = json.loads(json.dumps(aserver._to_dict(params)),
+                            object_hook=deserialize_message)
+    assert round_trip == params
+    assert round_trip.context.includeDeclaration is True
+
+
+@pytest.fixture
+def pool(workspace, monkeypatch):
+    """Return params of hover in the document and its result by the
+    server, the worker pool is forked after it."""
+    (workspace / 'dep.py').write_text('def foo():\n    """docstring"""\n')
+    uri = _put_document(workspace / 'main.py', 'from dep import foo\nfoo()\n')
+    params = _position_params(uri, 1, 1)
+    monkeypatch.setattr(server, 'show_message', Mock(), raising=False)
+    # create_pool replaces it
+    monkeypatch.setattr(sys, 'stdin', sys.stdin)
+    # Start Jedi subprocess before workers are forked
+    expected = aserver.hover(server, params).contents.value
+    assert expected.endswith('docstring')
+    worker_pool = aserver.create_pool(1, aserver._init_worker,
+                                      (server.workspace.root_uri,))
+    assert worker_pool is not None
+    monkeypatch.setattr(aserver, 'workerPool', worker_pool)
+    yield params, expected
+    worker_pool.shutdown()
+
+
+def _run_in_pool(f, params):
+    return asyncio.get_event_loop().run_until_complete(
+        aserver._run_in_pool(f, server, params))
+
+
+def _crash(ls, params):
+    os._exit(1)
+
+
+def test_worker_pool_requests(pool):
+    params, expected = pool
+    assert _run_in_pool(aserver.hover, params).contents.value == expected
+    assert _run_in_pool(aserver.definition, params) == [{
+        'uri': params.textDocument.uri,
+        'range': aserver._range(0, 16, 0, 19)
+    }]
+
+
+def test_worker_pool_crash(pool):
+    params, expected = pool
+    with pytest.raises(aserver.BrokenProcessPool):
+        _run_in_pool(_crash, params)
+    server.show_message.assert_called_once_with(
+        '_crash failed: worker process crashed', types.MessageType.Error)
+    # Crashed worker is replaced
+    assert _run_in_pool(aserver.hover, params).contents.value == expected
+
+
+def test_worker_pool_keeps_server_jedi(pool):
+    params, expected = pool
+    _run_in_pool(aserver.hover, params)
+    aserver.workerPool.shutdown()
+    # Workers don't use or kill Jedi subprocess of the server
+    assert not aserver.jediEnvironment._subprocess.is_crashed
+    assert aserver.hover(server, params).contents.value == expected
+
+
+@pytest.fixture
+def call_graph(workspace, monkeypatch):
+    """Return workspace folder with indexed call graph."""
+    (workspace / 'lib.py').write_text('''def helper():
+    pass
+
+
+class Runner:
+    def run(self):
+        self.step()
+        helper()
+
+    def step(self):
+        pass
+''')
+    (workspace / 'other.py').write_text('''class Other:
+    def step(self):
+        pass
+''')
+    (workspace / 'main.py').write_text('''from lib import Runner, helper
+
+
+def main(runner):
+    helper()
+    runner.step()
+    Runner().run()
+''')
+    (workspace / 'stack.py').write_text('''class Stack:
+    def append(self, x):
+        pass
+
+
+def build():
+    items = []
+    items.append(1)
+''')
+    monkeypatch.setattr(aserver, 'callGraph',
+                        aserver.CallGraph(str(workspace / 'cache')))
+    monkeypatch.setattr(aserver, 'callResolutions', {})
+    monkeypatch.setattr(aserver, 'modulePaths', {})
+    monkeypatch.setattr(aserver, 'callScripts', {})
+    for path in sorted(aserver._iter_workspace_files([str(workspace)])):
+        aserver._index_file(path)
+    return workspace
+
+
+def _call_params(path, name):
+    data = aserver._call_hierarchy_item(
+        str(path), aserver.callGraph.files[str(path)], name)
+    return json.loads(json.dumps({'item': data}),
+                      object_hook=deserialize_message)
+
+
+def _calls(result, key):
+    return [(call[key]['data']['name'],
+             [r['start']['line'] for r in call['fromRanges']])
+            for call in result]
+
+
+def test_prepare_call_hierarchy(call_graph):
+    main_uri = _put_document(call_graph / 'main.py')
+    items = aserver.prepare_call_hierarchy(
+        server, types.TextDocumentPositionParams(
+            types.TextDocumentIdentifier(main_uri), types.Position(4, 5)))
+    assert [(item['name'], item['uri']) for item in items] == [
+        ('helper', from_fs_path(str(call_graph / 'lib.py')))
+    ]
+
+
+def test_incoming_calls(call_graph):
+    incoming = aserver.incoming_calls(
+        server, _call_params(call_graph / 'lib.py', 'helper'))
+    assert _calls(incoming, 'from') == [('Runner.run', [7]), ('main', [4])]
+
+
+def test_incoming_calls_not_inferred(call_graph):
+    # runner.step() is ambiguous and Jedi can't infer runner
+    incoming = aserver.incoming_calls(
+        server, _call_params(call_graph / 'lib.py', 'Runner.step'))
+    assert _calls(incoming, 'from') == [('Runner.run', [6])]
+    assert aserver.callResolutions == {
+        str(call_graph / 'main.py'): {(5, 11): None}
+    }
+
+
+def test_incoming_calls_other_method(call_graph):
+    # The only indexed append() is not called by list.append()
+    stack_path = str(call_graph / 'stack.py')
+    assert aserver.incoming_calls(
+        server, _call_params(stack_path, 'Stack.append')) == []
+    assert aserver.callResolutions[stack_path] == {(7, 10): None}
+
+
+def test_outgoing_calls(call_graph):
+    outgoing = aserver.outgoing_calls(
+        server, _call_params(call_graph / 'main.py', 'main'))
+    assert _calls(outgoing, 'to') == [('helper', [4]), ('Runner', [6]),
+                                      ('Runner.run', [6])]
+
+
+def test_call_graph_file_changed(call_graph):
+    lib_path = str(call_graph / 'lib.py')
+    cache_dir = call_graph / 'cache'
+    old_hash = aserver.callGraph.files[lib_path]['hash']
+    assert (cache_dir / f'{old_hash}.json').exists()
+    (call_graph / 'lib.py').write_text('def helper():\n    helper()\n')
+    aserver._index_file(lib_path)
+    incoming = aserver.incoming_calls(
+        server, _call_params(lib_path, 'helper'))
+    assert _calls(incoming, 'from') == [('helper', [1]), ('main', [4])]
+    # Index of the changed file is saved by hash
+    content_hash = aserver.callGraph.files[lib_path]['hash']
+    assert aserver.CallGraph(str(cache_dir)).load(content_hash)
+    assert not (cache_dir / f'{old_hash}.json').exists()
+
+
+def test_call_graph_same_content(call_graph):
+    lib_path = str(call_graph / 'lib.py')
+    copy_path = str(call_graph / 'copy.py')
+    cache_dir = call_graph / 'cache'
+    (call_graph / 'copy.py').write_text((call_graph / 'lib.py').read_text())
+    aserver._index_file(copy_path)
+    content_hash = aserver.callGraph.files[lib_path]['hash']
+    assert aserver.callGraph.files[copy_path]['hash'] == content_hash
+    # Files with the same content share the saved index
+    aserver.callGraph.remove(copy_path)
+    assert aserver.CallGraph(str(cache_dir)).load(content_hash)
+    aserver.callGraph.remove(lib_path)
+    assert not (cache_dir / f'{content_hash}.json').exists()